@@ -9,14 +9,20 @@ word with its most common part of speech.
 import argparse
 from itertools import tee, izip
 from sys import stdout
-from collections import Counter
+from collections import OrderedDict
 
 from tablet import Line
+from frequency_index import FrequencyIndex
+from tag_matrix import TagMatrix
 
-# Index dictionary mapping words to their attested parts of speech and
-# the count for each of those POS.  
+# Index matrix counting the attested parts of speech of each word.
 
-INDEX = { }              # { 'x': { 'u' : 0 } }
+INDEX = TagMatrix()
+
+# Index kept on disk (--index), if any, in which words are looked up
+# instead of INDEX.
+
+INDEX_FILE = None
 
 # Initializer arg parser.
 
@@ -36,6 +42,15 @@ def init_parser():
                         help='File from which to read testing portion '
                              'of corpus.')
 
+    parser.add_argument('--index',
+                        type = str,
+                        default = '',
+                        help='File in which to keep the word/tag '
+                             'frequencies of the training corpus.  It '
+                             'is reused as long as the training corpus '
+                             'has the same path, size and content (by '
+                             'SHA-1) as when it was built.')
+
     return parser.parse_args()
 
 
@@ -51,11 +66,7 @@ def pairwise(iter):
 
 
 def optimizeIndex(args):
-    global INDEX
-
-    for word in INDEX:
-        (bestlem, bestcount) = INDEX[word].most_common(1)[0]
-        INDEX[word] = bestlem
+    INDEX.keep_best()
 
 
 def get_elements(filename, skip_first = False):
@@ -77,17 +88,41 @@ def get_elements(filename, skip_first = False):
             yield (elts[0], elts[-1])
 
 
-def buildIndex(args):
-    global INDEX
+def countTags(args):
+
+    # Count the tags of each word in the training corpus, in the order in
+    # which they were first seen.
+
+    counts = OrderedDict()
 
     # Skip the first line; it's got the feature header descriptions.
 
     for (word, pos) in get_elements(args.train, skip_first = True):
-        if not word in INDEX:
-            INDEX[word] = Counter()
+        tags = counts.setdefault(word, OrderedDict())
+        tags[pos] = tags.get(pos, 0) + 1
+
+    return [ (word, tags.items()) for (word, tags) in counts.iteritems() ]
+
 
-        counter = INDEX[word]
-        counter[pos] += 1
+def buildIndex(args):
+    global INDEX
+    global INDEX_FILE
+
+    if args.index:
+
+        # Build the index file again only if the training corpus has
+        # changed since it was built.  Words are then looked up in it as
+        # they are needed.
+
+        INDEX_FILE = FrequencyIndex(args.index)
+        if not INDEX_FILE.is_current(args.train):
+            INDEX_FILE.clear()
+            INDEX_FILE.add(countTags(args))
+            INDEX_FILE.set_source(args.train)
+            INDEX_FILE.commit()
+        return
+
+    INDEX.add(countTags(args))
 
     # Optimize the index; the baseline uses the most common POS tag
     # for a word.
@@ -95,6 +130,20 @@ def buildIndex(args):
     optimizeIndex(args)
 
 
+def bestTag(word):
+
+    # Most common tag of a word in the training corpus, or None for a
+    # word that isn't in it.
+
+    if INDEX_FILE is not None:
+        counts = INDEX_FILE.counts(word)
+        if not counts:
+            return None
+        return counts.most_common(1)[0][0]
+
+    return INDEX.best(word)
+
+
 def print_scores(caption, tp, fp, tn, fn):
 
     precision = float('nan')
@@ -123,11 +172,10 @@ def evaluate(args):
     (ntp, nfp, ntn, nfn) = (0, 0, 0, 0)    # Novel
 
     for (word, pos) in get_elements(args.test):
-        known = word in INDEX
+        guess = bestTag(word)
+        known = guess is not None
 
-        if known:
-            guess = INDEX[word]
-        else:
+        if not known:
 
             # This word is novel, not occurring in the training corpus.
             # Let's guess it's a PN!
@@ -165,7 +213,7 @@ def evaluate(args):
               'index_pos: {} ({}), correct: {}' \
                   .format( word,
                            pos, truth,
-                           INDEX[word], guess,
+                           INDEX.best(word), guess,
                            guess == truth )
         """
 
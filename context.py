@@ -1,7 +1,12 @@
 #!/usr/bin/python
 
+import heapq
+import re
+import zlib
+
+import numpy
+
 from tablet import Line
-from sys import stdout
 
 class Context:
 
@@ -73,40 +78,46 @@ class Context:
                 "zadim[stone-cutter]"
               ]
 
+    # The professions compiled for matching: a set for exact matches and
+    # a single pattern that finds any of them within a lemma.
 
-    @staticmethod
-    def get_left_context(line, index, word, args, offset = 1):
+    profession_set = frozenset(professions)
+
+    re_profession = re.compile('|'.join( [ re.escape(pf)
+                                           for pf in professions ] ))
 
-        (leftword, leftlem) = (None, None)
-        if (index - offset) >= 0:
-            (leftword, leftlem) = line.words[index - offset]
+    # Lemma token -> (is profession, contains profession).
 
-        if args.nogloss:
-            leftlem = Context.remove_gloss(leftlem)
+    profession_cache = { }
 
-        return (leftword, leftlem)
+
+    # Numeric classifiers; see "Preceded by numeric classifier" below.
+
+    classifiers = ( 'ba-an', 'ba-ri2-ga', 'bur3', 'da-na',
+                    'gin2-tur', 'gin2', 'gur-lugal', 
+                    'gur-sag-gal2', 'gur', 'iku', 'GAN2',
+                    'ku-li-mu', 'ku-li-kam', 'kusz3',
+                    'sar', 'sila3' )
 
 
     @staticmethod
-    def get_right_context(line, index, word, args, offset = 1):
+    def classify_lemma(lem):
 
-        (rightword, rightlem) = (None, None)
-        if (len(line.words) - 1) >= (index + offset):
-            (rightword, rightlem) = line.words[index + offset]
+        # Match a lemma token against the professions, once per distinct
+        # token.
 
-        if args.nogloss:
-            rightlem = Context.remove_gloss(rightlem)
+        match = Context.profession_cache.get(lem)
+        if match is None:
+            match = ( lem in Context.profession_set,
+                      Context.re_profession.search(lem) is not None )
+            Context.profession_cache[lem] = match
 
-        return (rightword, rightlem)
+        return match
 
 
     @staticmethod
-    def remove_gloss(lem):
-        if lem:
-            lem = list( set( [ l if not '[' in l
-                               else 'W' 
-                               for l in lem ] ))
-        return lem
+    def is_profession(lem):
+        return Context.classify_lemma(lem)[0]
 
 
     @staticmethod
@@ -117,314 +128,682 @@ class Context:
             return ','.join(lem)
 
 
+    """
+    select():
+    ===========
+    Look up features in the registry (FEATURES, below).
+    ===========
+    Accepts:
+        keys:   Feature keys, or None for every feature.
+    ===========
+    Returns:
+        The selected Features, in registry order.
+    ===========
+    """
     @staticmethod
-    def write_header():
-        stdout.write( '\tWord/Lemma (Do not use!)'
-                      '\tWord Index'
-                      '\tLeft Context Word'
-                      # '\tLeft Context Lemma'
-                      '\tRight Context Word'
-                      # '\tRight Context Lemma'
-                      '\tLine Context'
-                      '\tIs Word Alone On Line'
-                      '\tLeft context is dumu'
-                      '\tRight context is dumu'
-                      '\tNone ki (word) None'
-                      '\tNone igi (word) None'
-                      '\tNone igi (word)-sze3 None'
-                      '\tPersonnenkeil'
-                      '\tNone kiszib3 (word)'
-                      '\tNone giri3 (word)'
-                      '\tFirst syllable repeated'
-                      '\tLast syllable repeated'
-                      '\tAny syllable repeated'
-                      '\tIs profession'
-                      '\tContains profession'
-                      '\tLeft Context is profession'
-                      '\tLeft Context contains profession'
-                      '\tRight Context is profession'
-                      '\tRight Context contains profession'
-                      '\tStarts with ur-'
-                      '\tStarts with lu2-'
-                      '\tEnds with -mu'
-                      '\tContains {d}'
-                      '\tContains {ki}'
-                      '\tContains any determinative'
-                      '\tContains q sound'
-                      '\tContains lugal'
-                      '\tContains number'
-                      '\tFollowed by sag'
-                      '\tFollowed by zarin'
-                      '\tPreceded by numeric classifier'
-                      '\titi at head of sentence'
-                      '\tmu at head of sentence'
-                      # '\tIs PN'
-                      '\n' )
-                      
+    def select(keys = None):
+        if keys is None:
+            return list(FEATURES)
 
-    @staticmethod
-    def test_all(tests):
-        for t in tests:
-            if not t:
-                Context.test_fail()
-                return
-        Context.test_pass()
+        known = set( [ feature.key for feature in FEATURES ] )
+        unknown = [ key for key in keys if key not in known ]
+        if unknown:
+            raise ValueError('Unknown features: {}'
+                                 .format(', '.join(unknown)))
+
+        return [ feature for feature in FEATURES if feature.key in keys ]
 
 
     @staticmethod
-    def test_any(tests):
-        for t in tests:
-            if t:
-                Context.test_pass()
-                return
-        Context.test_fail()
-
-    
+    def write_header(out, features = None):
+        if features is None:
+            features = FEATURES
+
+        out.write( ''.join( [ '\t' + feature.name
+                              for feature in features ] ) + '\n' )
+
+
+    """
+    features():
+    ===========
+    Compute CRF features for every word in a batch of lines (such as all
+    of the lines of a tablet) at once.
+    ===========
+    Accepts:
+        lines:      Lemmatized Line objects.
+        features:   Features to compute; defaults to all of them.
+    ===========
+    Returns:
+        (matrix, columns), where matrix is a NumPy uint8 array with one
+        row per word, in line order, and one column per selected boolean
+        feature; and columns maps the key of each selected string
+        feature to a list of its values for the same rows.
+    ===========
+    """
     @staticmethod
-    def test_pass():
-        stdout.write( '\t{}'.format(1) )
+    def features(lines, features = None):
+        if features is None:
+            features = FEATURES
+
+        batch = Batch(lines)
+
+        booleans = [ feature.compute(batch) for feature in features
+                     if BOOLEAN == feature.kind ]
+        columns = dict( (feature.key, feature.compute(batch))
+                        for feature in features
+                        if STRING == feature.kind )
+
+        matrix = numpy.zeros( (batch.count, len(booleans)),
+                              dtype = numpy.uint8 )
+        for (i, values) in enumerate(booleans):
+            matrix[:, i] = values
+
+        return (matrix, columns)
+
+
+    """
+    rows():
+    ===========
+    Render the CRF features of a batch of lines as TSV, one string per
+    word, in the same order as features().  Each string holds the fields
+    that follow the word itself, each preceded by a tab.
+    ===========
+    """
+    @staticmethod
+    def rows(lines, features = None):
+        if features is None:
+            features = FEATURES
+
+        (matrix, columns) = Context.features(lines, features)
+        return Context.render(matrix, columns, features)
 
 
+    """
+    render():
+    ===========
+    Render features computed by features() as rows() does, for callers
+    that need both.
+    ===========
+    """
     @staticmethod
-    def test_fail():
-        stdout.write( '\t{}'.format(0) )
-        
+    def render(matrix, columns, features = None):
+        if features is None:
+            features = FEATURES
+
+        count = len(matrix)
+        fields = [ ]
+        block = [ ]
+        flag = 0
+
+        for feature in features:
+            if BOOLEAN == feature.kind:
+                block.append(matrix[:, flag])
+                flag += 1
+            else:
+                if block:
+                    fields.append(render_flags(block, count))
+                    block = [ ]
+                fields.append( [ '\t' + value
+                                 for value in columns[feature.key] ] )
+
+        if block:
+            fields.append(render_flags(block, count))
+
+        if not fields:
+            return [ '' ] * count
+
+        return [ ''.join(row) for row in zip(*fields) ]
+
+
+    """
+    attributes():
+    ===========
+    Render features computed by features() as CRFsuite attributes, one
+    string per word.  Each string holds the word itself and the
+    name=value attributes of the string features, each preceded by a
+    tab, followed by the names of the boolean features that are set.
+    Booleans that are not set are left out.
+    ===========
+    Accepts:
+        words:      The words of the rows.
+        matrix:     Boolean features, as returned by features().
+        columns:    String features, as returned by features().
+        features:   Features in matrix and columns.  word_lemma is never
+                        rendered, since it holds the tag being learned.
+        bits:       If nonzero, hash every attribute into a space of
+                        2 ** bits attributes, named by number.
+    ===========
+    """
+    @staticmethod
+    def attributes(words, matrix, columns, features = None, bits = 0):
+        if features is None:
+            features = FEATURES
 
+        if bits:
+            mask = (1 << bits) - 1
+            name = lambda attribute: str(zlib.crc32(attribute) & mask)
+        else:
+            name = lambda attribute: attribute.replace('\\', '\\\\') \
+                                              .replace(':', '\\:')
+
+        fields = [ [ '\t' + name('word=' + word) for word in words ] ]
+
+        for feature in features:
+            if STRING == feature.kind and 'word_lemma' != feature.key:
+                prefix = feature.key + '='
+                fields.append( [ '\t' + name(prefix + value)
+                                 for value in columns[feature.key] ] )
+
+        # Only a few booleans are set for any word, so pick them out of
+        # the matrix rather than walking every column.
+
+        flags = [ '\t' + name(feature.key) for feature in features
+                  if BOOLEAN == feature.kind ]
+        fields.append( [ '' ] * len(words) )
+        for (i, j) in zip(*numpy.nonzero(matrix)):
+            fields[-1][i] += flags[j]
+
+        return [ ''.join(row) for row in zip(*fields) ]
+
+
+    """
+    cached_rows():
+    ===========
+    Render the CRF features of a batch of lines as rows() does, reusing
+    the rows of lines seen before.  Every feature depends only on the
+    line a word is on, so a line with the same words and lemmata as one
+    already rendered has the same rows.
+    ===========
+    Accepts:
+        lines:      Lemmatized Line objects.
+        features:   Features to compute; defaults to all of them.
+        cache:      LineCache in which to keep the rows of each line.
+        render:     Function rendering the rows of a list of lines;
+                        defaults to rows().
+    ===========
+    """
     @staticmethod
-    def write(line, index, word, args):
+    def cached_rows(lines, features, cache, render = None):
+        if render is None:
+            render = lambda lines: Context.rows(lines, features)
+
+        # Lines without words have no rows.
+
+        keyed = [ (line, (line.line, tuple(line.words)))
+                  for line in lines if line.words ]
+        found = [ cache.get(key) for (_, key) in keyed ]
+
+        # Render the lines we haven't seen as a batch, each once, and
+        # split the rows up by line.
+
+        missing = { }
+        order = [ ]
+        for ((line, key), entry) in zip(keyed, found):
+            if entry is None and key not in missing:
+                missing[key] = line
+                order.append(key)
+
+        if order:
+            rows = render([ missing[key] for key in order ])
+            start = 0
+            for key in order:
+                end = start + len(missing[key].words)
+                missing[key] = rows[start:end]
+                cache.put(key, missing[key])
+                start = end
+
+            found = [ entry or missing[key]
+                      for ((_, key), entry) in zip(keyed, found) ]
+
+        return [ row for entry in found for row in entry ]
+
+
+class LineCache(object):
+
+    """
+    Least recently used cache of the feature rows of lines, keyed on the
+    line's words and lemmata.  When it is full, the least recently used
+    quarter of the entries is evicted at once, which keeps each lookup
+    to a couple of dict operations.  Counts hits and misses so that the
+    caller can report how well it did.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = { }
+        self.used = { }
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
 
-        # Variables that we may use as part of other features.
+        self.tick += 1
+        self.used[key] = self.tick
+        self.hits += 1
+        return entry
 
-        lemmata = line.get_lemmata(word)
-        signs = word.split('-')
 
-        (leftcx, leftlem) = \
-            Context.get_left_context(line, index, word, args)
+    def put(self, key, entry):
+        self.tick += 1
+        self.entries[key] = entry
+        self.used[key] = self.tick
 
-        (leftcx2, leftlem2) = \
-            Context.get_left_context(line, index, word, args, offset = 2)
+        if len(self.entries) > self.size:
+            evict = len(self.entries) - self.size * 3 // 4
+            for key in heapq.nsmallest(evict, self.used,
+                                       key = self.used.get):
+                del self.entries[key]
+                del self.used[key]
 
-        (rightcx, rightlem) = \
-            Context.get_right_context(line, index, word, args)
 
-        # Print raw lemma tag.  May include gloss, even when
-        # --nogloss switch is provided.  This is for the benefit
-        # of human readers with some familiarity with Sumerian.
- 
-        stdout.write( '\t"{}/{}"'.format( word,
-                                          Context.format_context(lemmata) ))
+def render_flags(block, count):
 
-        # Index of word in line.  0-based.
+    # Render a run of boolean features as tab-separated 0/1 digits for
+    # each word: interleave tabs with the digits for the whole batch at
+    # once, then slice it into per-word strings.
 
-        stdout.write( '\t{}'.format(index) )
+    size = 2 * len(block)
+    cells = numpy.empty( (count, size), dtype = numpy.uint8 )
+    cells[:, 0::2] = ord('\t')
+    for (i, values) in enumerate(block):
+        cells[:, 2 * i + 1] = values
+    cells[:, 1::2] += ord('0')
+    flags = cells.tostring()
 
-        # Left context.
+    return [ flags[i * size:(i + 1) * size] for i in xrange(count) ]
 
-        stdout.write( '\t{}'.format(leftcx) )
 
-        # Right context.
+class Batch(object):
 
-        stdout.write( '\t{}'.format(rightcx) )
+    """
+    The words of a batch of lines, integer-coded for feature computation.
+    Per-type tables for word and lemmata tests are built the first time a
+    feature asks for them, so unselected features cost nothing.
+    """
 
-        # Print line context.
+    def __init__(self, lines):
 
-        stdout.write( '\t"{}"'.format(line.line) )
+        # Lines without words contribute nothing.
 
-        # Is word alone on line ?
+        lines = [ line for line in lines if line.words ]
+        tokens = [ token for line in lines for token in line.words ]
 
-        Context.test_all([ (leftcx, rightcx) == (None, None) ])
-        
-        # Left context is dumu.
+        self.words = [ word for (word, _) in tokens ]
+        self.lemmata = [ lemmata for (_, lemmata) in tokens ]
+        self.lines = [ line for line in lines for _ in line.words ]
 
-        Context.test_all([ (leftcx == 'dumu') ])
+        # Per token, the only work is looking up the ids of its types.
 
-        # Right context is dumu.
+        word_types = { }
+        lemma_types = { }
+        word_ids = [ word_types.setdefault(word, len(word_types))
+                     for word in self.words ]
+        lemma_ids = [ lemma_types.setdefault(lemmata, len(lemma_types))
+                      for lemmata in self.lemmata ]
 
-        Context.test_all([ (rightcx == 'dumu') ])
+        counts = numpy.array( [ len(line.words) for line in lines ],
+                              dtype = numpy.intp )
+        starts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
 
-        # ^ ki <word> $
+        self.count = len(word_ids)
 
-        Context.test_all([ (leftcx2, leftcx, rightcx) == \
-                           (None, 'ki', None) ])
-            
-        # ^ igi <word> $
+        self.word_types = sorted(word_types, key = word_types.get)
+        self.lemma_types = sorted(lemma_types, key = lemma_types.get)
+        self.tables = { }
 
-        Context.test_all([ (leftcx2, leftcx, rightcx) == \
-                           (None, 'igi', None) ])
+        self.w = numpy.array(word_ids, dtype = numpy.intp)
+        self.l = numpy.array(lemma_ids, dtype = numpy.intp)
+        self.head = self.w[starts]
+        self.pos = numpy.arange(self.count, dtype = numpy.intp) - starts
+        self.length = numpy.repeat(counts, counts)
+        self.positions = self.pos.tolist()
 
-        # ^ igi <word>-sze $
+        # Neighbouring words.  The ids of a missing neighbour are
+        # meaningless; every use of them is masked by has_left/has_right.
 
-        Context.test_all([ (leftcx2, leftcx, rightcx) == (None, 'igi', None),
-                           word.endswith('-sze3') ])
+        self.has_left = self.pos > 0
+        self.has_right = self.pos < (self.length - 1)
+        self.left = numpy.roll(self.w, 1)
+        self.right = numpy.roll(self.w, -1)
+        self.left_l = numpy.roll(self.l, 1)
+        self.right_l = numpy.roll(self.l, -1)
 
-        # Personnenkeil: ^ 1(disz) <word> $
 
-        Context.test_all([ (leftcx2, leftcx, rightcx) == \
-                           (None, '1(disz)', None) ])
+    def word_table(self, test):
+        table = self.tables.get(test)
+        if table is None:
+            table = numpy.array( [ test(word) for word in self.word_types ],
+                                 dtype = bool )
+            self.tables[test] = table
+        return table
 
-        # ^ kiszib3 <word> $
 
-        Context.test_all([ (leftcx2, leftcx, rightcx) == \
-                           (None, 'kiszib3', None) ])
+    def lemma_table(self, test):
+        table = self.tables.get(test)
+        if table is None:
+            table = numpy.array( [ test(lemmata)
+                                   for lemmata in self.lemma_types ],
+                                 dtype = bool )
+            self.tables[test] = table
+        return table
 
-        # ^ giri3 <word> $
 
-        Context.test_all([ (leftcx2, leftcx, rightcx) == \
-                           (None, 'giri3', None) ])
+    def shape(self, bit):
 
-        # First syllable repeated
+        # Word-shape bitmask of each word type, looked up once per batch.
 
-        if len(signs) > 1:
-            Context.test_all([ signs[0] == signs[1] ])
-        else:
-            Context.test_fail()
+        shapes = self.tables.get(word_shape)
+        if shapes is None:
+            shapes = numpy.array( [ word_shape(word)
+                                    for word in self.word_types ],
+                                  dtype = numpy.uint16 )
+            self.tables[word_shape] = shapes
 
-        # Last syllable repeated
+        return ((shapes >> bit) & 1).astype(bool)[self.w]
 
-        signs = word.split('-')
-        if len(signs) > 1:
-            Context.test_all([ signs[-2] == signs[-1] ])
-        else:
-            Context.test_fail()
 
-        # Any syllable repeated
+    def word(self, test):
+        return self.word_table(test)[self.w]
 
-        if len(signs) > 1:
-            Context.test_any([ a == b for (a, b)
-                               in zip(signs, signs[1:]) ])
-        else:
-            Context.test_fail()
+    def left_word(self, test):
+        return self.has_left & self.word_table(test)[self.left]
 
-        # Is profession
+    def right_word(self, test):
+        return self.has_right & self.word_table(test)[self.right]
 
-        Context.test_any([ pf == lem
-                           for pf in Context.professions
-                           for lem in lemmata ])
+    def head_word(self, test):
+        return self.word_table(test)[self.head]
 
-        # Contains profession
+    def lemma(self, test):
+        return self.lemma_table(test)[self.l]
 
-        Context.test_any([ pf in lem 
-                           for pf in Context.professions
-                           for lem in lemmata ])
+    def left_lemma(self, test):
+        return self.has_left & self.lemma_table(test)[self.left_l]
 
-        # Left context is profession
+    def right_lemma(self, test):
+        return self.has_right & self.lemma_table(test)[self.right_l]
 
-        if leftlem:
-            Context.test_any([ pf == lem
-                               for pf in Context.professions
-                               for lem in line.get_lemmata(leftcx) ])
-        else:
-            Context.test_fail()
 
-        # Left context contains profession
+    def line_is(self, test):
+
+        # Lines of the form ^ <left> <word> $, where left passes test.
+
+        return (self.pos == 1) & (self.length == 2) & self.left_word(test)
+
+
+class Feature(object):
+
+    __slots__ = ( 'key', 'name', 'scope', 'kind', 'compute' )
+
+    """
+    __init__():
+    ===========
+    Constructor.
+    ===========
+    Accepts:
+        key:        Short name used to select the feature (--features).
+        name:       Column header.
+        scope:      WORD if the feature depends only on the word (and its
+                        lemmata), CONTEXT if it depends on neighbouring
+                        words, LINE if it depends on the whole line.
+        kind:       BOOLEAN or STRING.
+        compute:    Function taking a Batch and returning the feature for
+                        every word in it: a NumPy bool array for BOOLEAN
+                        features, a list of strings for STRING features.
+    ===========
+    """
+    def __init__(self, key, name, scope, kind, compute):
+        self.key = key
+        self.name = name
+        self.scope = scope
+        self.kind = kind
+        self.compute = compute
 
-        if leftlem:
-            Context.test_any([ pf in lem
-                               for pf in Context.professions
-                               for lem in line.get_lemmata(leftcx) ])
-        else:
-            Context.test_fail()
 
-        # Right context is profession
+WORD = 'word'
+CONTEXT = 'context'
+LINE = 'line'
 
-        if rightlem:
-            Context.test_any([ pf == lem
-                               for pf in Context.professions
-                               for lem in line.get_lemmata(rightcx) ])
-        else:
-            Context.test_fail()
+BOOLEAN = 'boolean'
+STRING = 'string'
 
-        # Right context contains profession
 
-        if rightlem:
-            Context.test_any([ pf in lem
-                               for pf in Context.professions
-                               for lem in line.get_lemmata(rightcx) ])
-        else:
-            Context.test_fail()
+# Tests on words and lemmata, shared between features so that each is
+# tabulated once per batch.
 
-        # Starts with ur-
+def equals(value):
+    return lambda word: word == value
 
-        Context.test_all([ word.startswith('ur-') ])
-        
-        # Starts with lu2-
+is_dumu = equals('dumu')
+is_ki = equals('ki')
+is_igi = equals('igi')
+is_disz = equals('1(disz)')
+is_kiszib = equals('kiszib3')
+is_giri = equals('giri3')
+is_sag = equals('sag')
+is_zarin = equals('zarin')
+is_iti = equals('iti')
+is_mu = equals('mu')
 
-        Context.test_all([ word.startswith('lu2-') ])
-        
-        # Ends with -mu
+def is_classifier(word):
+    return word in Context.classifiers
 
-        Context.test_all([ word.endswith('-mu') ])
-        
-        # Contains {d}
+# Word-shape features depend only on the word's own spelling.  They are
+# computed together, once per distinct word, and packed into a bitmask;
+# per word, they are then a table lookup.  Bit positions:
 
-        Context.test_all([ '{d}' in word ])
+FIRST_REPEATED = 0
+LAST_REPEATED = 1
+ANY_REPEATED = 2
+UR = 3
+LU2 = 4
+MU_SUFFIX = 5
+DINGIR = 6
+KI_DETERMINATIVE = 7
+DETERMINATIVE = 8
+Q = 9
+LUGAL = 10
+NUMBER = 11
 
-        # Contains {ki}
+# Word -> shape bitmask, for every word seen so far.
 
-        Context.test_all([ '{ki}' in word ])
+SHAPES = { }
 
-        # Contains any determinative
+def word_shape(word):
+    shape = SHAPES.get(word)
+    if shape is not None:
+        return shape
 
-        Context.test_all([ '{' in word ])
+    signs = word.split('-')
+    repeated = [ a == b for (a, b) in zip(signs, signs[1:]) ]
 
-        # Contains q sound
+    flags = ( repeated and repeated[0],
+              repeated and repeated[-1],
+              any(repeated),
+              word.startswith('ur-'),
+              word.startswith('lu2-'),
+              word.endswith('-mu'),
+              '{d}' in word,
+              '{ki}' in word,
+              '{' in word,
+              'q' in word,
+              'lugal' in word,
+              ('(asz)' in word) or ('(disz)' in word) or ('(u)' in word) )
 
-        Context.test_all([ 'q' in word ])
+    shape = 0
+    for (bit, flag) in enumerate(flags):
+        if flag:
+            shape |= 1 << bit
 
-        # Contains lugal
+    SHAPES[word] = shape
+    return shape
 
-        Context.test_all([ 'lugal' in word ])
+def is_profession(lemmata):
+    return any( [ Context.classify_lemma(lem)[0] for lem in lemmata ] )
 
-        # Contains numeric elements
+def contains_profession(lemmata):
+    return any( [ Context.classify_lemma(lem)[1] for lem in lemmata ] )
 
-        Context.test_any([ '(asz)' in word,
-                           '(disz)' in word,
-                           '(u)' in word ])
 
-        # Followed by sag
+def left_words(batch):
+    return [ batch.words[i - 1] if position > 0 else None
+             for (i, position) in enumerate(batch.positions) ]
 
-        Context.test_all([ rightcx == 'sag' ])
+def right_words(batch):
+    last = [ len(line.words) - 1 for line in batch.lines ]
+    return [ batch.words[i + 1] if position < last[i] else None
+             for (i, position) in enumerate(batch.positions) ]
 
-        # Followed by zarin
 
-        Context.test_all([ rightcx == 'zarin' ])
+"""
+Registry of CRF features, in output order.
+"""
 
-        # Preceded by numeric classifier
+FEATURES = [
 
-        Context.test_all([ leftcx in ( 'ba-an', 'ba-ri2-ga', 'bur3', 'da-na',
-                                       'gin2-tur', 'gin2', 'gur-lugal', 
-                                       'gur-sag-gal2', 'gur', 'iku', 'GAN2',
-                                       'ku-li-mu', 'ku-li-kam', 'kusz3',
-                                       'sar', 'sila3' ) ])
+    # Raw word and lemma tag.  May include gloss, even when --nogloss
+    # switch is provided.  This is for the benefit of human readers with
+    # some familiarity with Sumerian.
 
-        # iti at head of sentence
+    Feature('word_lemma', 'Word/Lemma (Do not use!)', WORD, STRING,
+            lambda b: [ '"{}/{}"'.format(word,
+                                         Context.format_context(lemmata))
+                        for (word, lemmata) in zip(b.words, b.lemmata) ]),
 
-        Context.test_all([ 'iti' == line.words[0][0] ])
+    # Index of word in line.  0-based.
 
-        # mu at head of sentence
+    Feature('index', 'Word Index', CONTEXT, STRING,
+            lambda b: [ str(position) for position in b.positions ]),
 
-        Context.test_all([ 'mu' == line.words[0][0] ])
+    # Left and right context.
 
-        """
-        # Print boolean feature, 1 if word is PN, 0 if not.
+    Feature('left', 'Left Context Word', CONTEXT, STRING,
+            lambda b: [ str(word) for word in left_words(b) ]),
 
-        if 'PN' in lemmata:
-            Context.test_pass()
-        else:
-            Context.test_fail()
+    Feature('right', 'Right Context Word', CONTEXT, STRING,
+            lambda b: [ str(word) for word in right_words(b) ]),
 
-        # Print most common tag for this word.
+    # Line context.
 
-        # Actually, don't print the most common tag for this word.
-        # This is not a good feature for CRF (or any feature-based
-        # NLP algorithm) since it's # not immediately calculable
-        # from context as a feature should be, but rather requires
-        # reference to the index of the entire corpus.
+    Feature('line', 'Line Context', LINE, STRING,
+            lambda b: [ '"{}"'.format(line.line) for line in b.lines ]),
 
-        if word in INDEX:
-        (bestlem, _) = INDEX[word].most_common(1)[0]
-        else:
-        bestlem = 'X'
+    Feature('alone', 'Is Word Alone On Line', LINE, BOOLEAN,
+            lambda b: 1 == b.length),
+
+    Feature('left_dumu', 'Left context is dumu', CONTEXT, BOOLEAN,
+            lambda b: b.left_word(is_dumu)),
+
+    Feature('right_dumu', 'Right context is dumu', CONTEXT, BOOLEAN,
+            lambda b: b.right_word(is_dumu)),
+
+    # ^ ki <word> $
+
+    Feature('ki', 'None ki (word) None', LINE, BOOLEAN,
+            lambda b: b.line_is(is_ki)),
+
+    # ^ igi <word> $
+
+    Feature('igi', 'None igi (word) None', LINE, BOOLEAN,
+            lambda b: b.line_is(is_igi)),
+
+    # ^ igi <word>-sze $
+
+    Feature('igi_sze3', 'None igi (word)-sze3 None', LINE, BOOLEAN,
+            lambda b: b.line_is(is_igi)
+                      & b.word(lambda word: word.endswith('-sze3'))),
+
+    # Personnenkeil: ^ 1(disz) <word> $
+
+    Feature('personnenkeil', 'Personnenkeil', LINE, BOOLEAN,
+            lambda b: b.line_is(is_disz)),
+
+    # ^ kiszib3 <word> $
+
+    Feature('kiszib3', 'None kiszib3 (word)', LINE, BOOLEAN,
+            lambda b: b.line_is(is_kiszib)),
+
+    # ^ giri3 <word> $
+
+    Feature('giri3', 'None giri3 (word)', LINE, BOOLEAN,
+            lambda b: b.line_is(is_giri)),
+
+    Feature('first_repeated', 'First syllable repeated', WORD, BOOLEAN,
+            lambda b: b.shape(FIRST_REPEATED)),
+
+    Feature('last_repeated', 'Last syllable repeated', WORD, BOOLEAN,
+            lambda b: b.shape(LAST_REPEATED)),
+
+    Feature('any_repeated', 'Any syllable repeated', WORD, BOOLEAN,
+            lambda b: b.shape(ANY_REPEATED)),
+
+    Feature('is_profession', 'Is profession', WORD, BOOLEAN,
+            lambda b: b.lemma(is_profession)),
+
+    Feature('contains_profession', 'Contains profession', WORD, BOOLEAN,
+            lambda b: b.lemma(contains_profession)),
+
+    Feature('left_is_profession', 'Left Context is profession',
+            CONTEXT, BOOLEAN,
+            lambda b: b.left_lemma(is_profession)),
+
+    Feature('left_contains_profession', 'Left Context contains profession',
+            CONTEXT, BOOLEAN,
+            lambda b: b.left_lemma(contains_profession)),
+
+    Feature('right_is_profession', 'Right Context is profession',
+            CONTEXT, BOOLEAN,
+            lambda b: b.right_lemma(is_profession)),
+
+    Feature('right_contains_profession',
+            'Right Context contains profession', CONTEXT, BOOLEAN,
+            lambda b: b.right_lemma(contains_profession)),
+
+    Feature('ur', 'Starts with ur-', WORD, BOOLEAN,
+            lambda b: b.shape(UR)),
+
+    Feature('lu2', 'Starts with lu2-', WORD, BOOLEAN,
+            lambda b: b.shape(LU2)),
+
+    Feature('mu_suffix', 'Ends with -mu', WORD, BOOLEAN,
+            lambda b: b.shape(MU_SUFFIX)),
+
+    Feature('dingir', 'Contains {d}', WORD, BOOLEAN,
+            lambda b: b.shape(DINGIR)),
+
+    Feature('ki_determinative', 'Contains {ki}', WORD, BOOLEAN,
+            lambda b: b.shape(KI_DETERMINATIVE)),
+
+    Feature('determinative', 'Contains any determinative', WORD, BOOLEAN,
+            lambda b: b.shape(DETERMINATIVE)),
+
+    Feature('q', 'Contains q sound', WORD, BOOLEAN,
+            lambda b: b.shape(Q)),
+
+    Feature('lugal', 'Contains lugal', WORD, BOOLEAN,
+            lambda b: b.shape(LUGAL)),
+
+    Feature('number', 'Contains number', WORD, BOOLEAN,
+            lambda b: b.shape(NUMBER)),
+
+    Feature('sag', 'Followed by sag', CONTEXT, BOOLEAN,
+            lambda b: b.right_word(is_sag)),
+
+    Feature('zarin', 'Followed by zarin', CONTEXT, BOOLEAN,
+            lambda b: b.right_word(is_zarin)),
+
+    Feature('classifier', 'Preceded by numeric classifier', CONTEXT, BOOLEAN,
+            lambda b: b.left_word(is_classifier)),
+
+    Feature('iti', 'iti at head of sentence', LINE, BOOLEAN,
+            lambda b: b.head_word(is_iti)),
 
-        stdout.write('\t{}'.format( formatLems([ bestlem ], args) ))
-        """
+    Feature('mu', 'mu at head of sentence', LINE, BOOLEAN,
+            lambda b: b.head_word(is_mu)),
+]
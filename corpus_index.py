@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+"""
+Byte-offset index over the tablets in an .atf file.
+
+The index records, for every tablet, where it lives in the .atf file
+along with a little metadata (language, whether it is lemmatized, and
+its line and word counts), so that single tablets or filtered subsets
+can be pulled out of the corpus without scanning the whole file.
+
+Index file layout (all integers little-endian):
+
+    header:     magic 'TIDX', version, tablet count, id table size,
+                    language table size
+    records:    one fixed-size record per tablet, in file order
+    id table:   tablet ids (e.g. P123456), concatenated
+    lang table: language names, newline-delimited; records refer to
+                    these by position
+"""
+
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+from tablet import Line
+
+MAGIC = 'TIDX'
+VERSION = 2
+
+HEADER = struct.Struct('<4sIIII')
+
+# offset, length, lines, words, id start, id length, language, flags
+
+RECORD = struct.Struct('<QIIIIHHB')
+
+FLAG_LEMMATIZED = 0x01
+
+TabletEntry = namedtuple('TabletEntry',
+                         [ 'id', 'offset', 'length', 'lang',
+                           'lemmatized', 'lines', 'words' ])
+
+
+"""
+scan_tablets():
+===========
+Scan an .atf file, yielding one TabletEntry per tablet.
+===========
+Accepts:
+    fin:    .atf file, opened for reading at its start.  Offsets are
+                counted from the bytes read, so this must not be a
+                decoded or decompressed stream.
+===========
+"""
+def scan_tablets(fin):
+
+    entry = None
+    pos = 0
+
+    for line in fin:
+        stripped = line.strip()
+
+        if stripped.startswith('&'):
+            if entry:
+                entry['length'] = pos - entry['offset']
+                yield TabletEntry(**entry)
+
+            # "&P123456 = Museum designation"; the id is the first token.
+
+            entry = { 'id': stripped[1:].split(' ', 1)[0].strip(),
+                      'offset': pos,
+                      'length': 0,
+                      'lang': '',
+                      'lemmatized': False,
+                      'lines': 0,
+                      'words': 0 }
+
+        elif entry and stripped:
+            if stripped.startswith('#atf') and 'lang' in stripped:
+                entry['lang'] = stripped.split()[-1]
+            elif stripped.startswith('#lem:'):
+                entry['lemmatized'] = True
+            elif stripped[0] not in Line.COMMENT:
+
+                # Transliteration line; the first token is the line
+                # number.
+
+                entry['lines'] += 1
+                entry['words'] += len(stripped.split()) - 1
+
+        pos += len(line)
+
+    if entry:
+        entry['length'] = pos - entry['offset']
+        yield TabletEntry(**entry)
+
+
+"""
+build_index():
+===========
+Build a tablet index for an .atf file.
+===========
+Accepts:
+    atf_filename:   .atf file to index.
+    index_filename: File to which to write the index.
+===========
+Returns:
+    Number of tablets indexed.
+===========
+"""
+def build_index(atf_filename, index_filename):
+
+    records = [ ]
+    ids = [ ]
+    id_size = 0
+    langs = { }
+
+    with open(atf_filename, 'rb') as fin:
+        for entry in scan_tablets(fin):
+            if entry.lang not in langs:
+                langs[entry.lang] = len(langs)
+
+            flags = FLAG_LEMMATIZED if entry.lemmatized else 0
+
+            records.append(RECORD.pack( entry.offset, entry.length,
+                                        entry.lines, entry.words,
+                                        id_size, len(entry.id),
+                                        langs[entry.lang], flags ))
+            ids.append(entry.id)
+            id_size += len(entry.id)
+
+    lang_table = '\n'.join( sorted(langs, key = langs.get) )
+
+    with open(index_filename, 'wb') as fout:
+        fout.write(HEADER.pack( MAGIC, VERSION, len(records),
+                                id_size, len(lang_table) ))
+        fout.write(''.join(records))
+        fout.write(''.join(ids))
+        fout.write(lang_table)
+
+    return len(records)
+
+
+class TabletIndex:
+
+    """
+    __init__():
+    ===========
+    Constructor.  Memory-maps the index and the .atf file it describes;
+    nothing is read until it is asked for.
+    ===========
+    Accepts:
+        index_filename: Index written by build_index().
+        atf_filename:   The .atf file that was indexed.
+    ===========
+    """
+    def __init__(self, index_filename, atf_filename):
+
+        self.index_file = open(index_filename, 'rb')
+        self.index = mmap.mmap(self.index_file.fileno(), 0,
+                               access = mmap.ACCESS_READ)
+
+        (magic, version, self.count, id_size, lang_size) = \
+            HEADER.unpack_from(self.index, 0)
+
+        if (MAGIC, VERSION) != (magic, version):
+            raise ValueError('{} is not a tablet index'
+                                 .format(index_filename))
+
+        self.records_start = HEADER.size
+        self.ids_start = self.records_start + self.count * RECORD.size
+
+        langs_start = self.ids_start + id_size
+        self.langs = self.index[langs_start:langs_start + lang_size] \
+                         .split('\n')
+
+        # An empty file cannot be mapped, but then it has no tablets to
+        # read either.
+
+        self.atf_file = open(atf_filename, 'rb')
+        if os.fstat(self.atf_file.fileno()).st_size:
+            self.atf = mmap.mmap(self.atf_file.fileno(), 0,
+                                 access = mmap.ACCESS_READ)
+        else:
+            self.atf = None
+
+        # Tablet id -> record number; built on the first lookup by id.
+
+        self.positions = None
+
+
+    def close(self):
+        self.index.close()
+        self.index_file.close()
+        if self.atf is not None:
+            self.atf.close()
+        self.atf_file.close()
+
+
+    def __len__(self):
+        return self.count
+
+
+    def entry(self, i):
+
+        (offset, length, lines, words, id_start, id_len, lang, flags) = \
+            RECORD.unpack_from(self.index,
+                               self.records_start + i * RECORD.size)
+
+        start = self.ids_start + id_start
+
+        return TabletEntry( self.index[start:start + id_len],
+                            offset, length, self.langs[lang],
+                            bool(flags & FLAG_LEMMATIZED),
+                            lines, words )
+
+
+    def entries(self):
+        for i in xrange(self.count):
+            yield self.entry(i)
+
+
+    def find(self, tablet_id):
+
+        if self.positions is None:
+            self.positions = dict( (entry.id, i)
+                                   for (i, entry)
+                                   in enumerate(self.entries()) )
+
+        i = self.positions.get(tablet_id)
+        if i is None:
+            return None
+
+        return self.entry(i)
+
+
+    def text(self, entry):
+
+        # Accept either an entry or a tablet id.
+
+        if not isinstance(entry, TabletEntry):
+            entry = self.find(entry)
+            if not entry:
+                return None
+
+        return self.atf[entry.offset:entry.offset + entry.length]
+
+
+    def select(self, lang = None, lemmatized = None):
+
+        # Yield entries for the tablets matching all of the given
+        # criteria; a criterion of None matches everything.
+
+        for entry in self.entries():
+            if lang is not None and lang != entry.lang:
+                continue
+            if lemmatized is not None and lemmatized != entry.lemmatized:
+                continue
+            yield entry
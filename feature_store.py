@@ -0,0 +1,312 @@
+#!/usr/bin/python
+
+"""
+Binary columnar store of CRF features.
+
+tag_corpus.py --crf --store writes the same words, features and tags as
+the CRF TSV, but column by column in binary, so that they can be
+memory-mapped straight into NumPy arrays instead of being split and
+parsed again by every consumer.
+
+A store is a directory holding:
+
+    store.json:     format version, counts, and the features stored, in
+                        registry order
+    vocab.dat:      every string value (words, tags and string
+                        features), each as a little-endian uint32 length
+                        followed by the string; string columns refer to
+                        these by position
+    tablets.dat:    tablet ids (e.g. P123456), length-prefixed as in
+                        vocab.dat; empty for a tablet without a & header
+    flags.bin:      boolean features, one row per word, bit-packed with
+                        numpy.packbits() (first feature in the high bit
+                        of the first byte)
+    word.bin:       vocabulary id of each word (int32)
+    tag.bin:        vocabulary id of the tag of each word (int32)
+    <key>.bin:      vocabulary id of each word's value of the string
+                        feature <key> (int32)
+    line_start.bin: index of the first word of each line, followed by
+                        the word count (int64)
+    damage.bin:     damage state of each line; see DAMAGE (uint8)
+    tablet_start.bin:
+                    index of the first line of each tablet, followed by
+                        the line count (int64)
+"""
+
+import json
+import os
+import struct
+
+import numpy
+
+from context import BOOLEAN, STRING
+
+VERSION = 2
+
+# Damage states of a line, by their code in damage.bin.
+
+DAMAGE = ( 'False', 'recoverable', 'unrecoverable' )
+
+CODES = numpy.int32
+OFFSETS = numpy.int64
+
+# Length of each string in vocab.dat and tablets.dat, which may hold any
+# bytes at all (newlines included).
+
+LENGTH = struct.Struct('<I')
+
+
+def write_strings(fout, strings):
+    for string in strings:
+        fout.write(LENGTH.pack(len(string)))
+        fout.write(string)
+
+
+def read_strings(fin):
+    data = fin.read()
+    strings = [ ]
+    pos = 0
+    while pos < len(data):
+        (length,) = LENGTH.unpack_from(data, pos)
+        pos += LENGTH.size
+        strings.append(data[pos:pos + length])
+        pos += length
+    return strings
+
+
+class FeatureStoreWriter:
+
+    """
+    __init__():
+    ===========
+    Constructor.  Creates the store directory if need be; columns are
+    appended to as tablets are added, so the store is never held in
+    memory.
+    ===========
+    Accepts:
+        directory:  Directory in which to write the store.
+        features:   Features being stored, in registry order.
+    ===========
+    """
+    def __init__(self, directory, features):
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.features = features
+        self.strings = [ feature.key for feature in features
+                         if STRING == feature.kind ]
+
+        self.vocab = { }
+        self.tablets = [ ]
+        self.words = 0
+        self.lines = 0
+
+        self.files = dict( (name, self.open(name + '.bin'))
+                           for name in [ 'flags', 'word', 'tag',
+                                         'line_start', 'damage',
+                                         'tablet_start' ]
+                                       + self.strings )
+
+
+    def open(self, filename):
+        return open(os.path.join(self.directory, filename), 'wb')
+
+
+    def codes(self, values):
+        vocab = self.vocab
+        return numpy.array( [ vocab.setdefault(value, len(vocab))
+                              for value in values ],
+                            dtype = CODES )
+
+
+    """
+    add_tablet():
+    ===========
+    Append a tablet to the store.
+    ===========
+    Accepts:
+        tablet_id:  Tablet id, or None for a tablet without a &
+                        header.
+        lines:      (damage, words) for each line of the tablet, where
+                        damage is one of DAMAGE and words is the number
+                        of words on the line.
+        words:      The words of the tablet, in line order.
+        tags:       The tag of each word.
+        matrix:     Boolean features of each word, as returned by
+                        Context.features().
+        columns:    String features of each word, as returned by
+                        Context.features().
+    ===========
+    """
+    def add_tablet(self, tablet_id, lines, words, tags, matrix, columns):
+
+        files = self.files
+
+        numpy.array( [ self.lines ], dtype = OFFSETS ) \
+            .tofile(files['tablet_start'])
+
+        counts = numpy.array( [ count for (_, count) in lines ],
+                              dtype = OFFSETS )
+        starts = self.words + numpy.cumsum(counts) - counts
+        starts.tofile(files['line_start'])
+
+        numpy.array( [ DAMAGE.index(damage) for (damage, _) in lines ],
+                     dtype = numpy.uint8 ).tofile(files['damage'])
+
+        numpy.packbits(matrix, axis = 1).tofile(files['flags'])
+        self.codes(words).tofile(files['word'])
+        self.codes(tags).tofile(files['tag'])
+        for key in self.strings:
+            self.codes(columns[key]).tofile(files[key])
+
+        self.tablets.append(tablet_id or '')
+        self.lines += len(lines)
+        self.words += len(words)
+
+
+    def close(self):
+
+        # Close the offset columns with the totals, so that every line
+        # and tablet has an end.
+
+        numpy.array( [ self.words ], dtype = OFFSETS ) \
+            .tofile(self.files['line_start'])
+        numpy.array( [ self.lines ], dtype = OFFSETS ) \
+            .tofile(self.files['tablet_start'])
+
+        for fout in self.files.values():
+            fout.close()
+
+        with self.open('vocab.dat') as fout:
+            write_strings(fout, sorted(self.vocab, key = self.vocab.get))
+
+        with self.open('tablets.dat') as fout:
+            write_strings(fout, self.tablets)
+
+        meta = { 'version': VERSION,
+                 'words': self.words,
+                 'lines': self.lines,
+                 'tablets': len(self.tablets),
+                 'features': [ { 'key': feature.key,
+                                 'name': feature.name,
+                                 'kind': feature.kind }
+                               for feature in self.features ] }
+
+        with self.open('store.json') as fout:
+            json.dump(meta, fout, indent = 4, sort_keys = True)
+
+
+class FeatureStore:
+
+    """
+    __init__():
+    ===========
+    Constructor.  Memory-maps the columns of a store; nothing is read
+    from them until it is asked for.
+    ===========
+    Accepts:
+        directory:  Directory written by FeatureStoreWriter.
+    ===========
+    """
+    def __init__(self, directory):
+
+        self.directory = directory
+
+        with open(self.path('store.json')) as fin:
+            meta = json.load(fin)
+
+        if VERSION != meta['version']:
+            raise ValueError('{} is not a version {} feature store'
+                                 .format(directory, VERSION))
+
+        self.count = meta['words']
+        self.features = meta['features']
+        self.booleans = [ feature['key'] for feature in self.features
+                          if BOOLEAN == feature['kind'] ]
+        self.strings = [ feature['key'] for feature in self.features
+                         if STRING == feature['kind'] ]
+
+        # Bytes per row of flags.bin.
+
+        width = (len(self.booleans) + 7) // 8
+
+        self.flags = self.map('flags', numpy.uint8, (self.count, width))
+        self.word = self.map('word', CODES, self.count)
+        self.tag = self.map('tag', CODES, self.count)
+        self.line_start = self.map('line_start', OFFSETS,
+                                   meta['lines'] + 1)
+        self.damage = self.map('damage', numpy.uint8, meta['lines'])
+        self.tablet_start = self.map('tablet_start', OFFSETS,
+                                     meta['tablets'] + 1)
+
+        with open(self.path('vocab.dat'), 'rb') as fin:
+            self.vocab = read_strings(fin)
+
+        with open(self.path('tablets.dat'), 'rb') as fin:
+            self.tablets = read_strings(fin)
+
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+
+    def map(self, name, dtype, shape):
+
+        # numpy.memmap() refuses to map an empty file.
+
+        if 0 == numpy.prod(shape):
+            return numpy.zeros(shape, dtype = dtype)
+
+        return numpy.memmap(self.path(name + '.bin'), dtype = dtype,
+                            mode = 'r', shape = shape)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def flag(self, key):
+
+        # Pull a single boolean feature out of the packed rows.
+
+        i = self.booleans.index(key)
+        return (self.flags[:, i // 8] >> (7 - i % 8)) & 1
+
+
+    def matrix(self):
+
+        # Every boolean feature, one column each, as in
+        # Context.features().
+
+        return numpy.unpackbits(self.flags, axis = 1) \
+                    [:, :len(self.booleans)]
+
+
+    def column(self, key):
+
+        # Vocabulary ids of a string feature.
+
+        if key not in self.strings:
+            raise KeyError(key)
+
+        return self.map(key, CODES, self.count)
+
+
+    def values(self, codes):
+        return [ self.vocab[code] for code in codes ]
+
+
+    def lines(self, tablet):
+
+        # Range of lines of the tablet at a given position.
+
+        return (self.tablet_start[tablet], self.tablet_start[tablet + 1])
+
+
+    def words(self, line):
+
+        # Range of words of the line at a given position.
+
+        return (self.line_start[line], self.line_start[line + 1])
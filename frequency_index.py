@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+"""
+Persistent word/tag frequency index.
+
+Counts how often each word is tagged with each tag (or lemma), in an
+SQLite database, so that the counts can be reused by later runs rather
+than derived again from the corpus.  Counts are kept in the order in
+which each word/tag pair was first added, so that an index loaded from
+disk iterates exactly like one built up in memory; ties between equally
+common tags are then broken the same way.
+
+The index also records the sources it was built from: for a corpus, the
+tablets added so far (by content hash), in order; for any other file,
+its name, size and content hash.
+"""
+
+import hashlib
+import os
+import sqlite3
+from collections import Counter, OrderedDict
+
+from tag_matrix import TagMatrix
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS counts ('
+        'id INTEGER PRIMARY KEY, word TEXT NOT NULL, tag TEXT NOT NULL, '
+        'count INTEGER NOT NULL, UNIQUE (word, tag))',
+    'CREATE TABLE IF NOT EXISTS tablets ('
+        'seq INTEGER PRIMARY KEY, key TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS meta ('
+        'name TEXT PRIMARY KEY, value TEXT)',
+]
+
+
+class FrequencyIndex:
+
+    """
+    __init__():
+    ===========
+    Constructor.  Opens the index, creating it if need be.
+    ===========
+    Accepts:
+        filename:   File holding the index.
+    ===========
+    """
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = str
+
+        for statement in SCHEMA:
+            self.db.execute(statement)
+
+        # Word -> Counter, for words looked up one at a time.
+
+        self.cache = { }
+
+
+    def commit(self):
+        self.db.commit()
+
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+    def clear(self):
+        for table in [ 'counts', 'tablets', 'meta' ]:
+            self.db.execute('DELETE FROM {}'.format(table))
+        self.cache = { }
+
+
+    def get_meta(self, name):
+        row = self.db.execute('SELECT value FROM meta WHERE name = ?',
+                              (name,)).fetchone()
+        return row[0] if row else None
+
+
+    def set_meta(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (name, value) '
+                        'VALUES (?, ?)', (name, value))
+
+
+    """
+    add():
+    ===========
+    Add word/tag counts to the index.  The counts are summed in memory
+    and then applied with one statement per batch, rather than one or
+    two per pair.
+    ===========
+    Accepts:
+        counts:     Sequence of (word, [ (tag, count), ... ]), in the
+                        order in which the pairs were seen.  A word may
+                        occur more than once, as when the counts of
+                        several tablets are added at once.
+    ===========
+    """
+    def add(self, counts):
+
+        # Pairs in the order in which they were first seen, so that new
+        # pairs are numbered in that order.
+
+        batch = OrderedDict()
+        for (word, tags) in counts:
+            for (tag, count) in tags:
+                batch[(word, tag)] = batch.get((word, tag), 0) + count
+
+        rows = [ (word, tag, count)
+                 for ((word, tag), count) in batch.iteritems() ]
+
+        if sqlite3.sqlite_version_info >= (3, 24, 0):
+            self.db.executemany(
+                'INSERT INTO counts (word, tag, count) VALUES (?, ?, ?) '
+                'ON CONFLICT (word, tag) DO UPDATE '
+                'SET count = count + excluded.count', rows)
+        else:
+
+            # No upsert: add to the pairs already in the index, then
+            # insert the rest.
+
+            self.db.executemany(
+                'UPDATE counts SET count = count + ? '
+                'WHERE word = ? AND tag = ?',
+                [ (count, word, tag) for (word, tag, count) in rows ])
+            self.db.executemany(
+                'INSERT OR IGNORE INTO counts (word, tag, count) '
+                'VALUES (?, ?, ?)', rows)
+
+        for (word, _) in batch:
+            self.cache.pop(word, None)
+
+
+    def load(self):
+
+        # The whole index, as a TagMatrix.
+
+        index = TagMatrix()
+        for (word, tag, count) in self.db.execute(
+                'SELECT word, tag, count FROM counts ORDER BY id'):
+            index.add_count(word, tag, count)
+
+        return index
+
+
+    def counts(self, word):
+
+        # Tag counts for a single word, read from disk the first time
+        # the word is asked for.  None for words not in the index.
+
+        if word not in self.cache:
+            rows = self.db.execute('SELECT tag, count FROM counts '
+                                   'WHERE word = ? ORDER BY id',
+                                   (word,)).fetchall()
+            counter = None
+            if rows:
+                counter = Counter()
+                for (tag, count) in rows:
+                    counter[tag] = count
+            self.cache[word] = counter
+
+        return self.cache[word]
+
+
+    def tablets(self):
+        return [ key for (key,) in self.db.execute(
+                     'SELECT key FROM tablets ORDER BY seq') ]
+
+
+    def add_tablets(self, keys):
+        self.db.executemany('INSERT INTO tablets (key) VALUES (?)',
+                            [ (key,) for key in keys ])
+
+
+    @staticmethod
+    def file_hash(filename):
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), ''):
+                digest.update(block)
+        return digest.hexdigest()
+
+
+    """
+    is_current():
+    ===========
+    Whether the index was built from a file as it is now: the file has
+    the recorded name, size and content.  Modification times are not
+    trusted, since a file copied or replaced with an older one may have
+    any time at all.  The content is only hashed if the rest matches.
+    ===========
+    """
+    def is_current(self, filename):
+        return self.get_meta('source') == os.path.abspath(filename) \
+               and self.get_meta('size') \
+                       == str(os.path.getsize(filename)) \
+               and self.get_meta('hash') == self.file_hash(filename)
+
+
+    def set_source(self, filename):
+        self.set_meta('source', os.path.abspath(filename))
+        self.set_meta('size', str(os.path.getsize(filename)))
+        self.set_meta('hash', self.file_hash(filename))
@@ -1,10 +1,12 @@
 #!/usr/bin/python
 
-import fileinput
 import argparse
+import os
 import random
+import shutil
+import tempfile
 from sys import stdout
-from itertools import tee, izip
+from multiprocessing import Pool
 
 from tablet import *
 
@@ -22,57 +24,147 @@ def init_parser():
                         help='Remove any lemmata in generated corpus.',
                         action='store_true')
 
+    parser.add_argument('--input',
+                        type=str,
+                        default='-',
+                        help='ATF file or .zip archive from which to read '
+                             'the corpus.  Defaults to stdin.')
+
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of processes across which to shard '
+                             'the corpus.  An archive or stdin is first '
+                             'extracted to a temporary file, which is '
+                             'then sharded.')
+
     return parser.parse_args()
 
-# Funny pattern for iterating via a pair of elements.
-# (0, 1), (1, 2), (2, 3), ... (n, None).
-# This is useful because we need to peek at the next line during forward
-# iteration to parse the lines in the .atf file efficiently.
+# Write a tablet's lines to the output if it passed the language and
+# lemmatization checks.
+
+def emit(tablet, args, out):
+    if tablet.lemmatized and tablet.in_language(args.lang):
+        for line in tablet.text:
+            if args.removelemmata and line.startswith('#lem:'):
+                continue
+            out.write(line + '\n')
+
+def filter_tablets(source, args, out, flush_last = False):
+
+    # Stream the input rather than reading it all into memory; only the
+    # current tablet is held.  A tablet is written out when the next &
+    # header shows up, so the last tablet in the stream is never written
+    # unless flush_last is set.
+
+    previous = None
+
+    for tablet in iter_tablets(source):
+        if previous:
+            emit(previous, args, out)
+        previous = tablet
+
+    if previous and flush_last:
+        emit(previous, args, out)
+
+# Find the byte offsets at which to split a file into roughly equal
+# shards.  Every offset except the last is the start of a line beginning
+# with a & tablet header, so that no tablet straddles two shards.
+
+def find_shards(filename, jobs):
+    size = os.path.getsize(filename)
+    offsets = [ 0 ]
+
+    with open(filename, 'r') as fin:
+        for i in range(1, jobs):
+            target = max(offsets[-1], size * i / jobs)
+            fin.seek(target)
+
+            # Skip the remainder of the line we landed in, unless we're
+            # sitting on the very first byte of the file.
+
+            pos = target
+            if target > 0:
+                pos += len(fin.readline())
+
+            line = fin.readline()
+            while line and not line.strip().startswith('&'):
+                pos += len(line)
+                line = fin.readline()
+
+            if line and pos > offsets[-1]:
+                offsets.append(pos)
+
+    offsets.append(size)
+
+    return zip(offsets, offsets[1:])
 
-def pairwise(iter):
-    a, b = tee(iter)
-    next(b, None)
-    return izip(a, b)
+# Read the lines in the byte range [start, end) of a file.
+
+def read_range(filename, start, end):
+    with open(filename, 'r') as fin:
+        fin.seek(start)
+        pos = start
+        while pos < end:
+            line = fin.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+# Filter a single shard of a file in a worker process, writing its
+# output to a temporary file and returning the file's name, so that no
+# more than a tablet of it is held in memory.  Every shard but the last
+# ends just before a & header, so its final tablet is complete and must
+# be flushed.
+
+def filter_shard(task):
+    (args, filename, start, end, flush_last) = task
+
+    with tempfile.NamedTemporaryFile(prefix = 'shard', suffix = '.atf',
+                                     delete = False) as out:
+        filter_tablets(read_range(filename, start, end), args, out,
+                       flush_last = flush_last)
+
+    return out.name
+
+def filter_shards(args, filename):
+    shards = find_shards(filename, args.jobs)
+    tasks = [ (args, filename, start, end, i < len(shards) - 1)
+              for (i, (start, end)) in enumerate(shards) ]
+
+    pool = Pool(args.jobs)
+
+    # imap() hands back results in task order, so the shards are
+    # concatenated in their original order.
+
+    for name in pool.imap(filter_shard, tasks):
+        with open(name, 'r') as shard:
+            shutil.copyfileobj(shard, stdout, 1 << 20)
+        os.remove(name)
+
+    pool.close()
+    pool.join()
 
 def parse(args):
-    lemma = False
-    valid = False 
-
-    lines = list()
-    for line in fileinput.input('-'):
-        lines.append(line)
-
-    # Pass '-' to input() to make sure fileinput doesn't interpret
-    # our command-line switches as filenames.
-
-    for line1, line2 in pairwise(lines):
-        line1 = line1.strip()
-        line2 = line2.strip()
-        if line1.startswith('&'):
-            lemma = False
-            valid = False 
-            lines = [ ]
-            lines.append(line1)
-        elif line1.startswith('#atf') and 'lang' in line1:
-            lines.append(line1)
-            if line1.endswith(args.lang):
-               valid = True 
-        else:
-            if line1.startswith('#lem:'):
-                lemma = True
-                if not args.removelemmata:
-                    lines.append(line1)
-            else:
-                lines.append(line1)
-
-        if line2.startswith('&'):
-            if lemma:
-                if valid:
-                    for line in lines:
-                        stdout.write(line + '\n')
-            lemma = False
-            valid = False 
-            lines = [ ]
+
+    if args.jobs <= 1:
+        filter_tablets(open_atf(args.input), args, stdout)
+
+    elif os.path.isfile(args.input) and not args.input.endswith('.zip'):
+        filter_shards(args, args.input)
+
+    else:
+
+        # Sharding needs random access to the input, so an archive
+        # member or stdin is extracted to a temporary file first.
+
+        with tempfile.NamedTemporaryFile(prefix = 'corpus',
+                                         suffix = '.atf') as extracted:
+            extracted.writelines(open_atf(args.input))
+            extracted.flush()
+
+            filter_shards(args, extracted.name)
 
 # ====
 # Main
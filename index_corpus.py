@@ -0,0 +1,32 @@
+#!/usr/bin/python
+
+import argparse
+from sys import stdout
+
+from corpus_index import build_index
+
+# Initializer arg parser.
+
+def init_parser():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--input',
+                        type=str,
+                        required=True,
+                        help='.atf file to index.')
+
+    parser.add_argument('--output',
+                        type=str,
+                        required=True,
+                        help='File to which to write the tablet index.')
+
+    return parser.parse_args()
+
+# ====
+# Main
+# ====
+
+args = init_parser()
+count = build_index(args.input, args.output)
+stdout.write('Indexed {} tablets.\n'.format(count))
@@ -0,0 +1,32 @@
+#!/usr/bin/python
+
+import argparse
+from sys import stdout
+
+from parsed_corpus import write_corpus
+
+# Initializer arg parser.
+
+def init_parser():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--input',
+                        type=str,
+                        required=True,
+                        help='Lemmatized .atf file to parse.')
+
+    parser.add_argument('--output',
+                        type=str,
+                        required=True,
+                        help='File to which to write the parsed corpus.')
+
+    return parser.parse_args()
+
+# ====
+# Main
+# ====
+
+args = init_parser()
+count = write_corpus(args.input, args.output)
+stdout.write('Parsed {} tablets.\n'.format(count))
@@ -0,0 +1,314 @@
+#!/usr/bin/python
+
+"""
+Parse-once binary form of a lemmatized corpus.
+
+Parsing the lines of the corpus (Line.clean() and Line.parse()) is the
+bulk of the work of reading it.  write_corpus() parses an .atf file once
+and records the outcome: the tablets, the parsed lines of each, and the
+cleaned words and lemmata of each line.  ParsedCorpus reads it back as
+tablets whose lines are rebuilt with Line.restore(), exactly as
+iter_tablets() and Tablet.lines would have parsed them, but without
+parsing anything.
+
+File layout (all integers little-endian):
+
+    header:     magic 'PCOR', version, tablet count, line count, word
+                    count, entry count, entry table size, text size
+    tablets:    one fixed-size record per tablet, in corpus order
+    lines:      one fixed-size record per parsed line, in corpus order
+    words:      entry number of each word, in corpus order
+    entries:    each distinct (word, lemmata) pair, as a length-prefixed
+                    word followed by its length-prefixed lemmata joined
+                    with |
+    text:       tablet ids and cleaned lines, concatenated; records
+                    refer to these by offset and length
+"""
+
+import mmap
+import shutil
+import struct
+import tempfile
+
+from tablet import Line, iter_tablets, open_atf
+
+MAGIC = 'PCOR'
+VERSION = 1
+
+HEADER = struct.Struct('<4sIIIIIQQ')
+
+# content hash (SHA-1 digest), id start, id length, first line, line
+# count, flags
+
+TABLET = struct.Struct('<20sQIIIB')
+
+# text start, text length, first word, word count, flags
+
+LINE = struct.Struct('<QIIIB')
+
+WORD = struct.Struct('<I')
+
+LENGTH = struct.Struct('<I')
+
+FLAG_HEADER = 0x01
+
+FLAG_LEM = 0x01
+FLAG_VALID = 0x02
+FLAG_DAMAGED = 0x04
+FLAG_DAMAGED_AND_TAGGED = 0x08
+
+
+"""
+write_corpus():
+===========
+Parse an .atf file and write it out in parsed form.  Tablets are parsed
+and written one at a time; only the distinct (word, lemmata) pairs are
+held in memory.
+===========
+Accepts:
+    atf_filename:       .atf file to parse, as accepted by open_atf().
+    parsed_filename:    File to which to write the parsed corpus.
+===========
+Returns:
+    Number of tablets written.
+===========
+"""
+def write_corpus(atf_filename, parsed_filename):
+
+    # The sections are written to temporary files as the corpus is read,
+    # then put together behind the header once their sizes are known.
+
+    sections = dict( (name, tempfile.TemporaryFile())
+                     for name in [ 'tablets', 'lines', 'words', 'text' ] )
+
+    entries = { }
+    counts = { 'tablets': 0, 'lines': 0, 'words': 0 }
+    text_size = [ 0 ]
+
+    def add_text(text):
+        start = text_size[0]
+        sections['text'].write(text)
+        text_size[0] += len(text)
+        return start
+
+    for tablet in iter_tablets(open_atf(atf_filename), keep_raw = False):
+        tablet_id = tablet.id
+        flags = FLAG_HEADER if tablet.header is not None else 0
+
+        sections['tablets'].write(TABLET.pack(
+            tablet.key.decode('hex'), add_text(tablet_id or ''),
+            len(tablet_id or ''), counts['lines'], len(tablet.lines),
+            flags ))
+        counts['tablets'] += 1
+
+        for line in tablet.lines:
+            flags = ( (FLAG_LEM if line.lem else 0)
+                    | (FLAG_VALID if line.valid else 0)
+                    | (FLAG_DAMAGED if line.damaged else 0)
+                    | (FLAG_DAMAGED_AND_TAGGED
+                           if line.damaged_and_tagged else 0) )
+
+            sections['lines'].write(LINE.pack(
+                add_text(line.line), len(line.line), counts['words'],
+                len(line.words), flags ))
+            counts['lines'] += 1
+
+            sections['words'].write(''.join(
+                [ WORD.pack(entries.setdefault(entry, len(entries)))
+                  for entry in line.words ] ))
+            counts['words'] += len(line.words)
+
+    entry_table = [ ]
+    for (word, lemmata) in sorted(entries, key = entries.get):
+        lemmata = '|'.join(lemmata)
+        entry_table.append(LENGTH.pack(len(word)) + word
+                           + LENGTH.pack(len(lemmata)) + lemmata)
+    entry_table = ''.join(entry_table)
+
+    with open(parsed_filename, 'wb') as fout:
+        fout.write(HEADER.pack( MAGIC, VERSION, counts['tablets'],
+                                counts['lines'], counts['words'],
+                                len(entries), len(entry_table),
+                                text_size[0] ))
+
+        for name in [ 'tablets', 'lines', 'words' ]:
+            sections[name].seek(0)
+            shutil.copyfileobj(sections[name], fout)
+
+        fout.write(entry_table)
+
+        sections['text'].seek(0)
+        shutil.copyfileobj(sections['text'], fout)
+
+    for section in sections.values():
+        section.close()
+
+    return counts['tablets']
+
+
+"""
+is_parsed_corpus():
+===========
+Whether a file was written by write_corpus().
+===========
+"""
+def is_parsed_corpus(filename):
+    with open(filename, 'rb') as fin:
+        return MAGIC == fin.read(len(MAGIC))
+
+
+class ParsedTablet(object):
+
+    __slots__ = ( 'corpus', 'position', 'parsed' )
+
+    """
+    __init__():
+    ===========
+    Constructor.  Stands in for a Tablet read from the corpus; nothing
+    is read until it is asked for.
+    ===========
+    Accepts:
+        corpus:     ParsedCorpus holding the tablet.
+        position:   Number of the tablet in the corpus.
+    ===========
+    """
+    def __init__(self, corpus, position):
+        self.corpus = corpus
+        self.position = position
+        self.parsed = None
+
+
+    @property
+    def id(self):
+        return self.corpus.tablet_id(self.position)
+
+
+    @property
+    def key(self):
+        return self.corpus.tablet_key(self.position)
+
+
+    @property
+    def lines(self):
+        if self.parsed is None:
+            self.parsed = self.corpus.lines(self.position)
+        return self.parsed
+
+
+class ParsedCorpus:
+
+    """
+    __init__():
+    ===========
+    Constructor.  Memory-maps a parsed corpus.  Only the (word, lemmata)
+    pairs are read up front, so that every occurrence of a pair shares
+    a single entry, as with a Vocabulary.
+    ===========
+    Accepts:
+        filename:   File written by write_corpus().
+    ===========
+    """
+    def __init__(self, filename):
+
+        self.file = open(filename, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0,
+                              access = mmap.ACCESS_READ)
+
+        (magic, version, self.count, line_count, word_count, entry_count,
+         entry_size, text_size) = HEADER.unpack_from(self.data, 0)
+
+        if (MAGIC, VERSION) != (magic, version):
+            raise ValueError('{} is not a parsed corpus'.format(filename))
+
+        self.tablets_start = HEADER.size
+        self.lines_start = self.tablets_start + self.count * TABLET.size
+        self.words_start = self.lines_start + line_count * LINE.size
+        entries_start = self.words_start + word_count * WORD.size
+        self.text_start = entries_start + entry_size
+
+        self.entries = [ ]
+        pos = entries_start
+        for i in xrange(entry_count):
+            (length,) = LENGTH.unpack_from(self.data, pos)
+            word = self.data[pos + LENGTH.size:pos + LENGTH.size + length]
+            pos += LENGTH.size + length
+
+            (length,) = LENGTH.unpack_from(self.data, pos)
+            lemmata = self.data[pos + LENGTH.size:pos + LENGTH.size + length]
+            pos += LENGTH.size + length
+
+            self.entries.append( ( intern(word),
+                                   tuple( [ intern(lem)
+                                            for lem in lemmata.split('|') ]
+                                        ) ) )
+
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+    def __len__(self):
+        return self.count
+
+
+    def text(self, start, length):
+        start += self.text_start
+        return self.data[start:start + length]
+
+
+    def record(self, position):
+        return TABLET.unpack_from(self.data,
+                                  self.tablets_start
+                                      + position * TABLET.size)
+
+
+    def tablet(self, position):
+        return ParsedTablet(self, position)
+
+
+    def tablets(self):
+        for position in xrange(self.count):
+            yield ParsedTablet(self, position)
+
+
+    def tablet_id(self, position):
+
+        # As Tablet.id: None for a tablet without a & header.
+
+        (_, id_start, id_length, _, _, flags) = self.record(position)
+        if not flags & FLAG_HEADER:
+            return None
+        return self.text(id_start, id_length)
+
+
+    def tablet_key(self, position):
+        return self.record(position)[0].encode('hex')
+
+
+    def lines(self, position):
+
+        # The tablet's lines, as Tablet.lines would have parsed them.
+
+        (_, _, _, first, count, _) = self.record(position)
+
+        data = self.data
+        entries = self.entries
+        lines = [ ]
+
+        for i in xrange(first, first + count):
+            (text_start, text_length, word_start, word_count, flags) = \
+                LINE.unpack_from(data, self.lines_start + i * LINE.size)
+
+            words = [ entries[entry] for entry in struct.unpack_from(
+                          '<{}I'.format(word_count), data,
+                          self.words_start + word_start * WORD.size) ]
+
+            lines.append(Line.restore(self.text(text_start, text_length),
+                                      bool(flags & FLAG_LEM),
+                                      bool(flags & FLAG_VALID),
+                                      bool(flags & FLAG_DAMAGED),
+                                      bool(flags & FLAG_DAMAGED_AND_TAGGED),
+                                      words))
+
+        return lines
@@ -1,9 +1,10 @@
 #!/usr/bin/python
 
 import argparse
-import fileinput
+import hashlib
+import os
 from fractions import gcd
-from sys import stdout
+from sys import stdin, stdout
 
 # Constants.
 
@@ -11,12 +12,22 @@ DMG_NONE = 0
 DMG_RECOVERABLE = 1
 DMG_UNRECOVERABLE = 2
 
+# Size of the buffers through which the corpora are written.
+
+OUTPUT_BUFFER = 1 << 20
+
 # Initializer arg parser.
 
 def init_parser():
 
     parser = argparse.ArgumentParser()
 
+    parser.add_argument('--input',
+                        type = str,
+                        default = '-',
+                        help='CRF corpus to partition, as written by '
+                             'tag_corpus.py --crf.  Defaults to stdin.')
+
     parser.add_argument('--train',
                         type = str,
                         required = True,
@@ -48,7 +59,43 @@ def init_parser():
                         help='Percentage of input corpus to allocate to '
                              'training corpus.')
 
-    return parser.parse_args()
+    parser.add_argument('--folds',
+                        type = int,
+                        default = 0,
+                        help='Instead of a single split, write the '
+                             'training and testing corpora of each of '
+                             'this many cross-validation folds.  Each '
+                             'tablet is tested in the fold chosen by a '
+                             'hash of its P-number, and trained on in '
+                             'all of the others.  The corpus filenames '
+                             'must contain {}, which is replaced by the '
+                             'fold number.  Requires --ids.')
+
+    parser.add_argument('--ids',
+                        type = str,
+                        default = '',
+                        help='With --folds, the tablet ids written by '
+                             'tag_corpus.py --ids along with the CRF '
+                             'corpus, from which the P-number of each '
+                             'tablet is taken.')
+
+    args = parser.parse_args()
+
+    if args.folds:
+        if args.folds < 2:
+            parser.error('--folds must be at least 2')
+
+        if not args.ids:
+            parser.error('--folds requires --ids')
+
+        for filename in [ args.train, args.test_remove_damage,
+                          args.test_permit_damage ]:
+            if '{}' not in filename:
+                parser.error('With --folds, corpus filenames must '
+                             'contain {} for the fold number: '
+                             + filename)
+
+    return args
 
 def get_tablets(lines):
 
@@ -96,29 +143,44 @@ def get_tablets(lines):
         yield tablet
 
 
-def partition(args):
+def open_input(args):
+
+    # Stream the corpus rather than reading it all into memory; only the
+    # current tablet is held.
 
-    lines = [ ]
-    for line in fileinput.input('-'):
-        lines.append(line)
+    if '-' == args.input:
+        return stdin
+    return open(args.input, 'r')
 
-    ftrain = open(args.train, 'w')
 
-    # Write all lines up to and including the first blank line in the
-    # corpus to the training corpus; it contains the header.
-    # Save the rest of the lines away.  We'll be iterating over them soon.
+def read_header(fin):
 
-    loop = True
-    while loop:
-        line = lines.pop(0)
-        ftrain.write(line)
+    # All lines up to and including the first blank line in the corpus
+    # make up the header.  The rest of the lines are read as we go.
+
+    header = [ ]
+    for line in fin:
+        header.append(line)
         if '\n' == line:
-            loop = False
+            break
+
+    return ''.join(header)
+
+
+def partition(args):
+
+    fin = open_input(args)
+
+    ftrain = open(args.train, 'w', OUTPUT_BUFFER)
+
+    # Write the header to the training corpus.
+
+    ftrain.write(read_header(fin))
 
     # Open file handles to the testing corpora files.
 
-    ftest_r = open(args.test_remove_damage, 'w')
-    ftest_p = open(args.test_permit_damage, 'w')
+    ftest_r = open(args.test_remove_damage, 'w', OUTPUT_BUFFER)
+    ftest_p = open(args.test_permit_damage, 'w', OUTPUT_BUFFER)
 
     # Make sure that testing output files start with a blank line.
     # Training output file has a header that will include that line for us.
@@ -135,33 +197,40 @@ def partition(args):
     count = trainmax
     fouts = [ ftrain ]
 
-    for tablet in get_tablets(lines):
+    for tablet in get_tablets(fin):
         for fout in fouts:
-            for (line, damage_state) in tablet:
 
-                if ftrain == fout:
+            # Each tablet is written out whole, rather than a line at a
+            # time.
 
-                    # Write only undamaged lines to the training corpus;
-                    # the tags in the training corpus must be absolutely
-                    # certain.
+            if ftrain == fout:
 
-                    if (DMG_NONE == damage_state):
-                        fout.write(line)
+                # Write only undamaged lines to the training corpus;
+                # the tags in the training corpus must be absolutely
+                # certain.
 
-                elif ftest_r == fout:
+                fout.write(''.join( [ line for (line, damage_state)
+                                      in tablet
+                                      if DMG_NONE == damage_state ] ))
 
-                    # Write only undamaged lines to this testing corpus.
+            elif ftest_r == fout:
 
-                    if (DMG_NONE == damage_state):
-                        fout.write(line)
+                # Write only undamaged lines to this testing corpus.
 
-                elif ftest_p == fout:
+                fout.write(''.join( [ line for (line, damage_state)
+                                      in tablet
+                                      if DMG_NONE == damage_state ] ))
 
-                    # Permit damaged lines in this testing corpus only
-                    # if they are recoverably damaged.
+            elif ftest_p == fout:
 
-                    if damage_state in (DMG_NONE, DMG_RECOVERABLE):
-                        fout.write(line)
+                # Permit damaged lines in this testing corpus only
+                # if they are recoverably damaged.
+
+                fout.write(''.join( [ line for (line, damage_state)
+                                      in tablet
+                                      if damage_state in (DMG_NONE,
+                                                          DMG_RECOVERABLE)
+                                    ] ))
 
 
         # Tablet has been written to the appropriate corpora.
@@ -182,10 +251,108 @@ def partition(args):
     ftest_r.close()
     ftest_p.close()
 
+    if fin is not stdin:
+        fin.close()
+
+
+def get_fold(tablet_id, folds):
+
+    # The fold of a tablet depends only on its own P-number, so that it
+    # stays put however the rest of the corpus changes.
+
+    digest = hashlib.sha1(tablet_id).hexdigest()
+    return int(digest[:8], 16) % folds
+
+
+def partition_folds(args):
+
+    # The ids file has a line for each tablet of the CRF corpus, in
+    # order; the two are read side by side, in a single pass.
+
+    fids = open(args.ids, 'r')
+    fin = open_input(args)
+    header = read_header(fin)
+
+    filenames = [ ]
+    ftrains = [ ]
+    ftests_r = [ ]
+    ftests_p = [ ]
+
+    for fold in range(args.folds):
+        names = [ filename.format(fold)
+                  for filename in [ args.train, args.test_remove_damage,
+                                    args.test_permit_damage ] ]
+        filenames.extend(names)
+
+        ftrains.append(open(names[0], 'w', OUTPUT_BUFFER))
+        ftests_r.append(open(names[1], 'w', OUTPUT_BUFFER))
+        ftests_p.append(open(names[2], 'w', OUTPUT_BUFFER))
+
+        # As with a single split, the training corpora start with the
+        # header and the testing corpora with a blank line.
+
+        ftrains[fold].write(header)
+        ftests_r[fold].write('\n')
+        ftests_p[fold].write('\n')
+
+    error = None
+
+    for tablet in get_tablets(fin):
+        tablet_id = fids.readline()
+        if not tablet_id:
+            error = '{} has more tablets than {} has ids'
+            break
+
+        tablet_fold = get_fold(tablet_id.rstrip('\n'), args.folds)
+
+        # Undamaged lines go to the training corpora and the first
+        # testing corpus; recoverably damaged ones also go to the second
+        # testing corpus.
+
+        undamaged = ''.join( [ line for (line, damage_state) in tablet
+                               if DMG_NONE == damage_state ] )
+        recoverable = ''.join( [ line for (line, damage_state) in tablet
+                                 if damage_state in (DMG_NONE,
+                                                     DMG_RECOVERABLE) ] )
+
+        for fold in range(args.folds):
+            if tablet_fold == fold:
+                ftests_r[fold].write(undamaged)
+                ftests_p[fold].write(recoverable)
+            else:
+                ftrains[fold].write(undamaged)
+
+    else:
+        if fids.readline():
+            error = '{} has fewer tablets than {} has ids'
+
+    for fout in ftrains + ftests_r + ftests_p:
+        fout.close()
+
+    fids.close()
+    if fin is not stdin:
+        fin.close()
+
+    # Folds split from mismatched files would be wrong; don't leave
+    # them behind.
+
+    if error:
+        for filename in filenames:
+            os.remove(filename)
+
+        raise ValueError((error + '; were they written by the same run '
+                                  'of tag_corpus.py?')
+                             .format('stdin' if fin is stdin
+                                             else args.input,
+                                     args.ids))
+
 
 # ====
 # Main
 # ====
 
 args = init_parser()
-partition(args)
+if args.folds:
+    partition_folds(args)
+else:
+    partition(args)
@@ -1,8 +1,55 @@
 #!/usr/bin/python
 
+import fileinput
+import hashlib
+import io
 import re
+import zipfile
 
-class Line:
+class Vocabulary(object):
+
+    """
+    Maps each (word, lemma token) pair, such as ('ur-{d}nanna', 'PN'), to
+    an entry for Line.words.  The word and its lemmata are interned
+    strings and the lemmata are a tuple, so every occurrence of a pair
+    read through the same vocabulary shares a single entry.  The reader
+    of a corpus owns its vocabulary, which is freed along with it.
+    """
+
+    __slots__ = ( 'entries', )
+
+    def __init__(self):
+        self.entries = { }
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def entry(self, word, tokens):
+
+        # The key is made of interned strings too, so that it holds on
+        # to nothing the entry doesn't already: its word is the entry's
+        # word, and for a single lemma, so is its token.
+
+        key = (intern(word), intern(tokens))
+        entry = self.entries.get(key)
+
+        if entry is None:
+            entry = ( key[0],
+                      tuple( [ intern(element)
+                               for element in tokens.split('|') ] ) )
+            self.entries[key] = entry
+
+        return entry
+
+
+class Line(object):
+
+    # Lines are created by the hundreds of thousands, so keep them small.
+
+    __slots__ = ( 'line', 'lem', 'valid', 'damaged', 'damaged_and_tagged',
+                  'words' )
 
     COMMENT = '&$@#'
 
@@ -22,15 +69,53 @@ class Line:
     re_word = re.compile(r"[A-Za-z0-9-]")
 
     """
+    Transliteration markup, matched in a single pass over the line.  Each
+    alternative starts with a different character; MARKUP gives its
+    replacement, keyed on that character.  (Keeping capturing groups out
+    of the pattern lets the regex engine skip quickly to the characters
+    that can start a match.)
+
+    Independent comma tokens are reduced to a single space, and a comma
+    at the end of the line is dropped.
+
+    s, (Akkadian soft sz) is replaced with sz, except at the end of the
+    line, where the comma is dropped like any other trailing comma.
+
+    Erasures: !(...) follows a sign that was erased and corrected by the
+    scribe, as in "ma-na!(KI)-ag2".  Obliterate the erased signs, along
+    with any further parenthesized signs directly following them (even
+    if implied signs come between them).
+
     Implied signs: <<...>> indicates that the transliterator believes that
     the scribe has left out one or more signs.  These omitted signs will
     not appear in the lemmatization and so we need to remove the implied
-    signs.
+    signs.  For example,
+
+        mu ha-ar-szi{ki} <<masz>> ki-masz{ki} ba-hul
+        #lem: mu[year]; GN; GN; hulu[destroy]
+
+    [...] indicates the loss of an indeterminate number of signs.  Reduce
+    this to x, a single lost sign, for our purposes.
+
+    An erasure or implied sign with no closing delimiter is left alone;
+    its delimiters are removed with the rest of the noise.
     """
 
-    re_impl = re.compile(r"\<\<([A-Za-z0-9-()/#?*{}|@+ ]+)\>\>")
+    re_clean = re.compile(r" , "
+                          r"|,\Z"
+                          r"|s,(?!\Z)"
+                          r"|!(?:(?:<<[A-Za-z0-9-()/#?*{}|@+ ]+>>)*\([^)]*\))+"
+                          r"|<<.*?>>"
+                          r"|\.\.\.")
+
+    MARKUP = { ' ': ' ',
+               ',': '',
+               's': 'sz',
+               '!': '',
+               '<': '',
+               '.': 'x' }
+
 
-        
     """
     __init__():
     ===========
@@ -40,9 +125,17 @@ class Line:
         line:   Line from tablet.
         lem:    Corresponding lemma for line.  If line is a comment,
                     lem may be None.
+        keep_raw:
+                If False, discard the raw lemmatization once the line
+                    has been parsed; lem is then only a flag recording
+                    whether the line was lemmatized.
+        vocabulary:
+                Vocabulary through which to share word entries with
+                    other lines.  If None, entries are shared within
+                    the line only.
     ===========
     """
-    def __init__(self, line, lem):
+    def __init__(self, line, lem, keep_raw = True, vocabulary = None):
         self.line = line
         self.lem = lem
         self.valid = None
@@ -57,18 +150,52 @@ class Line:
             self.lem = lem[5:]
 
         self.words = [ ]
-        self.parse()
+        self.parse(vocabulary)
+
+        if not keep_raw:
+            self.lem = bool(self.lem)
+
+
+    """
+    restore():
+    ===========
+    Rebuild a line from the results of an earlier parse() (see
+    parsed_corpus.py), without parsing it again.  As with keep_raw =
+    False, lem is only a flag recording whether the line was lemmatized.
+    ===========
+    """
+    @staticmethod
+    def restore(line, lem, valid, damaged, damaged_and_tagged, words):
+        self = Line.__new__(Line)
+        self.line = line
+        self.lem = lem
+        self.valid = valid
+        self.damaged = damaged
+        self.damaged_and_tagged = damaged_and_tagged
+        self.words = words
+        return self
 
 
     def get_lemmata(self, word):
 
+        # Lemmata of the first occurrence of word in the line.  A word
+        # may occur more than once with different lemmata; when the
+        # position of the word is known, use get_lemmata_at() instead.
+
         for (w, lemmata) in self.words:
             if word == w:
                 return lemmata
         return None
 
 
-    def parse(self):
+    def get_lemmata_at(self, index):
+        return self.words[index][1]
+
+
+    def parse(self, vocabulary = None):
+
+        if vocabulary is None:
+            vocabulary = Vocabulary()
 
         if not self.lem:
             self.valid = True
@@ -116,7 +243,8 @@ class Line:
 
                     break
 
-                in_comment = self.add_word(word, tokens, in_comment)
+                in_comment = self.add_word(word, tokens, in_comment,
+                                           vocabulary)
 
             # Now that all of the words have been added to the line,
             # scan for damaged signs.
@@ -124,7 +252,7 @@ class Line:
             self.scan_for_damage()
 
 
-    def add_word(self, word, tokens, in_comment):
+    def add_word(self, word, tokens, in_comment, vocabulary):
 
         # There is some additional transliteration noise in
         # the form of bare colons.  I'm not sure what they
@@ -168,14 +296,9 @@ class Line:
 
             return True
 
-        elements = [ ]
-        self.words.append( (word, elements) )
+        # Tag the word with the lemma token.
 
-        for element in tokens.split('|'):
-
-            # Tag the word with the lemma token.
-
-            elements.append(element)
+        self.words.append(vocabulary.entry(word, tokens))
 
         # Not in a comment.
 
@@ -218,84 +341,21 @@ class Line:
                     return
 
 
-    def removeAdditions(self, line):
-
-        """
-        Sometimes, scribes will leave out words that are implied by 
-        context, or may simply have left out a word that the transliterator
-        felt was recoverable from context.  For example,
-
-        mu ha-ar-szi{ki} <<masz>> ki-masz{ki} ba-hul
-        #lem: mu[year]; GN; GN; hulu[destroy]
-
-        However, since these words aren't in the original text, any such
-        additions by the transliterator are not lemmatized; as such,
-        remove them from the line.
-        """
+    @staticmethod
+    def replace_markup(match):
+        return Line.MARKUP[match.group()[0]]
 
-        start = line.find("<<")
-        while -1 != start:
-            end = line.find(">>", start + 1)
-            if -1 != end:
-                line = line[:start + 1] + line[end + 1:]
-            start = line.find("<<")
 
-        return line;
-
-
-    def removeErasures(self, line):
-        start = line.find("!(")
-
-        # Obliterate any erased signs where they are specified; for instance,
-        # replace "ma-na!(KI)-ag2" with "ma-na!-ag2".  We'll deal with the
-        # remaining ! metacharacter elsewhere.
-
-        while -1 != start:
-            end = line.find(")", start + 1)
-            if -1 != end:
-                line = line[:start + 1] + line[end + 1:]
-            start = line.find("!(")
-
-        return line;
-      
     def clean(self, line, lem):
 
         # Remove first word from line.
 
-        line = ' '.join( [ word for word
-                           in line.split(' ') ]
-                         [1:] )
-
-        # Remove any independent comma tokens.
-
-        line = line.replace(' , ', ' ')
-
-        # Remove commas at the end of the line.
-
-        if line.endswith(','):
-            line = line[:-1]
-
-        # Delete any implied signs <<...>>.
-
-        line = Line.re_impl.sub('', line)
-
-        # Replace s, (Akkadian soft sz) with sz.
-
-        line = line.replace('s,', 'sz')
+        line = line.partition(' ')[2]
 
-        # Remove any signs that were erased and corrected by the scribe.
+        # Deal with commas, erasures, implied signs and lost signs.
+        # See re_clean.
 
-        line = self.removeErasures(line)
-
-        # Remove any signs that were omitted by the scribe but added by
-        # the transliterator.
-
-        line = self.removeAdditions(line)
-
-        # [...] indicates the loss of an indeterminate number of
-        # signs.  Reduce this to x, a single lost sign, for our purposes.
-
-        line = re.sub(r'\.\.\.', 'x', line)
+        line = Line.re_clean.sub(Line.replace_markup, line)
 
         """
         # Deal with slashes; they may be either " " or "-".
@@ -328,3 +388,165 @@ class Line:
         line = line.translate(None, Line.NOISE)
 
         return line
+
+
+class Tablet(object):
+
+    __slots__ = ( 'text', 'keep_raw', 'vocabulary', 'parsed' )
+
+    """
+    __init__():
+    ===========
+    Constructor.  Nothing is parsed until the lines are asked for.
+    ===========
+    Accepts:
+        text:       Stripped lines of the tablet, starting with its
+                        & header (if any).
+        keep_raw:   Passed on to each Line; see Line.__init__().
+        vocabulary: Vocabulary shared with other tablets, or None to
+                        share entries within this tablet only.
+    ===========
+    """
+    def __init__(self, text, keep_raw = True, vocabulary = None):
+        self.text = text
+        self.keep_raw = keep_raw
+        self.vocabulary = vocabulary
+        self.parsed = None
+
+
+    @property
+    def header(self):
+
+        # Lines before the first & header of a stream form a tablet
+        # without one.
+
+        if self.text and self.text[0].startswith('&'):
+            return self.text[0]
+        return None
+
+
+    @property
+    def id(self):
+
+        # "&P123456 = Museum designation"; the id is the first token.
+
+        header = self.header
+        if not header:
+            return None
+        return header[1:].split(' ', 1)[0].strip()
+
+
+    @property
+    def key(self):
+
+        # Hash of the tablet's content, under which results for it can
+        # be kept from one run to the next.
+
+        return hashlib.sha1('\n'.join(self.text)).hexdigest()
+
+
+    @property
+    def lemmatized(self):
+        for line in self.text:
+            if line.startswith('#lem:'):
+                return True
+        return False
+
+
+    def in_language(self, lang):
+        for line in self.text:
+            if line.startswith('#atf') and 'lang' in line \
+                                       and line.endswith(lang):
+                return True
+        return False
+
+
+    @property
+    def lines(self):
+
+        # Parse each line that is followed by a lemmatization, the first
+        # time the lines are asked for.
+
+        if self.parsed is None:
+            vocabulary = self.vocabulary
+            if vocabulary is None:
+                vocabulary = Vocabulary()
+
+            self.parsed = [ Line(line1, line2, keep_raw = self.keep_raw,
+                                 vocabulary = vocabulary)
+                            for (line1, line2)
+                            in zip(self.text, self.text[1:])
+                            if line2.startswith('#lem:') ]
+
+        return self.parsed
+
+
+"""
+iter_tablets():
+===========
+Split a stream of ATF lines into tablets, yielding each Tablet as soon
+as the & header of the next one is read.  Only one tablet is held in
+memory at a time.
+===========
+Accepts:
+    fileobj:    Any iterable of ATF lines, such as a file or the result
+                    of open_atf().
+    keep_raw:   Passed on to each Tablet.
+    vocabulary: Vocabulary shared by all of the tablets.  If None, a new
+                    one is made for this pass over the stream, and freed
+                    along with its tablets.
+===========
+"""
+def iter_tablets(fileobj, keep_raw = True, vocabulary = None):
+
+    if vocabulary is None:
+        vocabulary = Vocabulary()
+
+    text = [ ]
+
+    for line in fileobj:
+        line = line.strip()
+        if line.startswith('&'):
+            if text:
+                yield Tablet(text, keep_raw, vocabulary)
+            text = [ ]
+        text.append(line)
+
+    if text:
+        yield Tablet(text, keep_raw, vocabulary)
+
+
+"""
+open_atf():
+===========
+Open a source of ATF lines for streaming.
+===========
+Accepts:
+    filename:   '-' for stdin, a plain .atf file, or a .zip archive
+                    (such as cdli_atffull.zip) containing an .atf member.
+                    Archive members are decompressed incrementally as
+                    they are read, so they never need to be extracted
+                    to disk.
+===========
+"""
+def open_atf(filename):
+
+    if '-' == filename:
+
+        # Pass '-' to input() to make sure fileinput doesn't interpret
+        # our command-line switches as filenames.
+
+        return fileinput.input('-')
+
+    if filename.endswith('.zip'):
+        archive = zipfile.ZipFile(filename)
+        members = [ name for name in archive.namelist()
+                    if name.endswith('.atf') ]
+
+        if not members:
+            raise ValueError('No .atf file found in {}'.format(filename))
+
+        return io.BufferedReader(archive.open(members[0]),
+                                 buffer_size = 1 << 20)
+
+    return open(filename, 'r')
@@ -4,27 +4,52 @@ import argparse
 import operator
 import random
 import re
-import fileinput
-from itertools import tee, izip
-from sys import stdout
-from collections import Counter
-
-from tablet import Line
-from context import Context
+import shelve
+import os
+import shutil
+import stat
+import tempfile
+from sys import stdin, stdout, stderr
+from collections import Counter, OrderedDict, deque
+from multiprocessing import Pool
+
+from tablet import Tablet, iter_tablets
+from context import Context, LineCache
+from feature_store import FeatureStoreWriter
+from frequency_index import FrequencyIndex
+from parsed_corpus import ParsedCorpus, is_parsed_corpus
+from tag_matrix import TagMatrix
 
 # TODO: Remove INDEX
 # TODO: Remove args.bestlemma [except maybe for dumpindex]
 
-# Lines read from input stream.
-# We'll be doing two passes over the input stream so we need to save
-# what we read.
+# Input corpus, and the offset at which it starts.  We'll be doing two
+# passes over the input, so it must be seekable; each pass seeks back to
+# the start and streams it again.
+
+INPUT = None
+INPUT_START = 0
+
+# The input, if it is a corpus already parsed by parse_corpus.py.
+
+PARSED = None
+
+# Index matrix counting the attested parts of speech of each word.
+
+INDEX = TagMatrix()
+
+# Size of the buffer through which the output is written.
+
+OUTPUT_BUFFER = 1 << 20
 
-LINES = list()
+# Number of tablets whose features are computed together.
 
-# Index dictionary mapping words to their attested parts of speech and
-# the count for each of those POS.  
+TABLET_GROUP = 256
 
-INDEX = { }              # { 'x': { 'u' : 0 } }
+# Options of the run, as seen by the functions run in worker processes
+# with --jobs.
+
+JOB_ARGS = None
 
 # Initializer arg parser.
 
@@ -32,6 +57,13 @@ def init_parser():
 
     parser = argparse.ArgumentParser()
 
+    parser.add_argument('--input',
+                        type=str,
+                        default='-',
+                        help='Lemmatized .atf file from which to read the '
+                             'corpus, or the same corpus as parsed by '
+                             'parse_corpus.py.  Defaults to stdin.')
+
     parser.add_argument('--nogloss',
                         action='store_true',
                         help='Suppress translation glosses.  Glosses '
@@ -62,56 +94,431 @@ def init_parser():
                         help='Writes a word/tag frequency matrix in CSV ' \
                              'format to the specified filename')
 
-    return parser.parse_args()
+    parser.add_argument('--cache',
+                        type=str,
+                        default='',
+                        help='File in which to keep per-tablet results '
+                             'keyed on tablet content hashes.  On later '
+                             'runs, only tablets that were added or '
+                             'changed are parsed and tagged again.')
+
+    parser.add_argument('--index',
+                        type=str,
+                        default='',
+                        help='File in which to keep the word/lemma '
+                             'frequency index between runs.  Tablets '
+                             'added to the end of the corpus are added '
+                             'to it in place; any other change rebuilds '
+                             'it.')
+
+    parser.add_argument('--features',
+                        type=str,
+                        default='',
+                        help='Comma-separated keys of the CRF features '
+                             'to compute (see context.FEATURES).  '
+                             'Defaults to all of them.')
+
+    parser.add_argument('--crfsuite',
+                        action='store_true',
+                        help='With --crf, write the features in CRFsuite '
+                             'item-sequence format instead of TSV: one '
+                             'sequence per line, one item per word, '
+                             'labelled with its tag.')
+
+    parser.add_argument('--hash-bits',
+                        type=int,
+                        default=0,
+                        help='With --crfsuite, hash the attributes into '
+                             'a space of 2 ** HASH_BITS attributes, to '
+                             'bound the memory a trainer needs.')
+
+    parser.add_argument('--line-cache',
+                        type=int,
+                        default=100000,
+                        help='Number of distinct lines whose CRF features '
+                             'are kept for reuse by repeated lines.  0 '
+                             'computes every line afresh.  Not used with '
+                             '--store.')
+
+    parser.add_argument('--store',
+                        type=str,
+                        default='',
+                        help='Directory in which to also write the CRF '
+                             'features as a binary columnar store (see '
+                             'feature_store.py).  Requires --crf or a '
+                             'crf output.')
+
+    parser.add_argument('--ids',
+                        type=str,
+                        default='',
+                        help='File to which to also write the id (e.g. '
+                             'P123456) of each tablet written to the '
+                             'outputs, one per line and in the same '
+                             'order, so that the tablets of the CRF '
+                             'output can be told apart (see '
+                             'partition_corpus.py --folds).  The line is '
+                             'empty for a tablet without a & header.')
+
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of processes across which to index '
+                             'and tag the corpus.  Tablets are handed out '
+                             'in groups, and written out in their original '
+                             'order.')
+
+    parser.add_argument('--output',
+                        type=str,
+                        action='append',
+                        default=[ ],
+                        help='FORMAT:FILE.  Write one of the outputs of '
+                             'this run to FILE, in one of the formats '
+                             '{}.  Append +pf to the format to set --pf '
+                             'for this output only.  May be given more '
+                             'than once, so that several outputs come '
+                             'from a single pass over the corpus; the '
+                             'other options apply to all of them.  '
+                             'Without it, the output selected by --bare, '
+                             '--crf and --crfsuite goes to stdout.'
+                             .format(', '.join(FORMATS)))
+
+    args = parser.parse_args()
+
+    if args.output and (args.bare or args.crf or args.crfsuite):
+        parser.error('--output gives the format of each output; it '
+                     'cannot be combined with --bare, --crf or '
+                     '--crfsuite')
+
+    if args.crfsuite and not args.crf:
+        parser.error('--crfsuite requires --crf')
+
+    try:
+        args.outputs = [ outputOptions(args, spec)
+                         for spec in args.output ] \
+                       or [ outputOptions(args) ]
+    except ValueError as e:
+        parser.error(str(e))
+
+    crf_outputs = [ output for output in args.outputs if output.crf ]
 
+    if args.store and not crf_outputs:
+        parser.error('--store requires --crf or a crf output')
 
-# Funny pattern for iterating via a pair of elements.
-# (0, 1), (1, 2), (2, 3), ... (n, None).
-# This is useful because we need to peek at the next line during forward
-# iteration to parse the lines in the .atf file efficiently.
+    if args.hash_bits and not [ output for output in crf_outputs
+                                if output.crfsuite ]:
+        parser.error('--hash-bits requires --crfsuite or a crfsuite '
+                     'output')
 
-def pairwise(iter):
-    a, b = tee(iter)
-    next(b, None)
-    return izip(a, b)
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
 
+    if not 0 <= args.hash_bits <= 32:
+        parser.error('--hash-bits must be between 0 and 32')
+
+    # Replace the feature keys with the selected features.
+
+    try:
+        keys = None
+        if args.features:
+            keys = [ key.strip() for key in args.features.split(',') ]
+        args.features = Context.select(keys)
+    except ValueError as e:
+        parser.error(str(e))
+
+    for output in args.outputs:
+        output.features = args.features
+
+    return args
+
+
+# Output formats, and the options each one sets.
+
+FORMATS = OrderedDict([
+    ('tagged',      { 'bare': False, 'crf': False, 'crfsuite': False }),
+    ('bare',        { 'bare': True,  'crf': False, 'crfsuite': False }),
+    ('crf',         { 'bare': False, 'crf': True,  'crfsuite': False }),
+    ('crfsuite',    { 'bare': False, 'crf': True,  'crfsuite': True }),
+])
+
+
+def outputOptions(args, spec = None):
+
+    # The options for a single output: a copy of args with the output's
+    # format applied, and its own file and memo of formatted tags.  With
+    # no spec, the output goes to stdout as selected by the flags.
+
+    output = argparse.Namespace(**vars(args))
+    output.tags = { }
+
+    if spec is None:
+        output.filename = '-'
+        return output
+
+    (format, _, filename) = spec.partition(':')
+    modifiers = format.split('+')
+
+    if modifiers[0] not in FORMATS or not filename:
+        raise ValueError('Bad output "{}"; expected FORMAT:FILE with '
+                         'FORMAT one of {}'
+                             .format(spec, ', '.join(FORMATS)))
+
+    for modifier in modifiers[1:]:
+        if 'pf' != modifier:
+            raise ValueError('Unknown output option "{}" in "{}"'
+                                 .format(modifier, spec))
+        output.pf = True
+
+    for (option, value) in FORMATS[modifiers[0]].iteritems():
+        setattr(output, option, value)
+
+    output.filename = filename
+    return output
+
+
+def openInput(args):
+    global INPUT
+    global INPUT_START
+    global PARSED
+
+    if '-' != args.input and is_parsed_corpus(args.input):
+        PARSED = ParsedCorpus(args.input)
+        return
+
+    if '-' != args.input:
+        INPUT = open(args.input, 'r')
+        INPUT_START = 0
+        return
+
+    # Stdin redirected from a file can be read again in place.  Anything
+    # else (such as a pipe) is spooled to a temporary file first.
+
+    if stat.S_ISREG(os.fstat(stdin.fileno()).st_mode):
+        INPUT = os.fdopen(os.dup(stdin.fileno()), 'r')
+        INPUT_START = INPUT.tell()
+    else:
+        INPUT = tempfile.TemporaryFile()
+        shutil.copyfileobj(stdin, INPUT, OUTPUT_BUFFER)
+        INPUT_START = 0
+
+
+def getTablets():
+
+    # A tablet is only written to the output once the next & header is
+    # seen, so the last tablet in the stream is flagged as not written.
+
+    previous = None
+
+    if PARSED is not None:
+        tablets = PARSED.tablets()
+    else:
+        INPUT.seek(INPUT_START)
+        tablets = iter_tablets(INPUT, keep_raw = False)
 
-def readLines():
-    global LINES
+    for tablet in tablets:
+        if previous:
+            yield (previous, True)
+        previous = tablet
 
-    LINES = list()
-    for line in fileinput.input('-'):
-        LINES.append(line)
+    if previous:
+        yield (previous, False)
 
 
-def buildIndex():
-    global LINES
+def groupTablets(tablets):
 
-    for line1, line2 in pairwise(LINES):
-        line1 = line1.strip()
-        line2 = line2.strip()
+    # Tablets are handled in groups, so that the fixed cost of handing
+    # them to a worker (or of computing their features) is paid once per
+    # group rather than once per tablet.
 
-        # If we see a lemmatization ...
+    group = [ ]
+    for tablet in tablets:
+        group.append(tablet)
+        if len(group) == TABLET_GROUP:
+            yield group
+            group = [ ]
 
-        if line2.startswith('#lem:'):
-            line = Line(line1, line2)
-            if line.valid:
-                for (word, _) in line.words:
+    if group:
+        yield group
 
-                    """
-                    if ':' == word:
-                        print 'line: {}'.format(line.line)
-                        print 'lem:  {}'.format(line.lem)
-                        raise
-                    """
 
-                    if not word in INDEX:
-                        INDEX[word] = Counter()
+def openPool(args):
+    if args.jobs < 2:
+        return None
+    return Pool(args.jobs, initJob, (args,))
 
-                    # Track lemma token count.
 
-                    for lem in line.get_lemmata(word):
-                        INDEX[word][lem] += 1
+def initJob(args):
+    global JOB_ARGS
+
+    JOB_ARGS = args
+
+
+def closePool(pool):
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def mapTasks(function, tasks, pool, args):
+
+    # Apply function to the argument of each (context, argument) task,
+    # yielding (context, result) in task order.  With a pool, at most two
+    # tasks per worker are in flight at once, so that the corpus is still
+    # streamed rather than queued up in full as pool.imap() would.
+
+    if pool is None:
+        for (context, argument) in tasks:
+            yield (context, function(argument))
+        return
+
+    pending = deque()
+    for (context, argument) in tasks:
+        pending.append( (context, pool.apply_async(function, (argument,))) )
+        if len(pending) >= 2 * args.jobs:
+            (context, result) = pending.popleft()
+            yield (context, result.get())
+
+    while pending:
+        (context, result) = pending.popleft()
+        yield (context, result.get())
+
+
+def tabletHandle(tablet):
+
+    # What a worker is given to get hold of a tablet: its position in
+    # the parsed corpus, or else its text.
+
+    if PARSED is not None:
+        return tablet.position
+    return tablet.text
+
+
+def loadTablet(handle):
+    if PARSED is not None:
+        return PARSED.tablet(handle)
+    return Tablet(handle, keep_raw = False)
+
+
+def countLemmata(lines):
+
+    # Count the lemma tokens for each word in a tablet's lines.  Words
+    # and lemmata are kept in the order in which they were first seen,
+    # so that adding the counts to INDEX gives exactly the same INDEX
+    # as adding the tokens one at a time.
+
+    counts = OrderedDict()
+
+    for line in lines:
+        if line.valid:
+            for (word, lemmata) in line.words:
+                lemcounts = counts.setdefault(word, OrderedDict())
+
+                # Track lemma token count.
+
+                for lem in lemmata:
+                    lemcounts[lem] = lemcounts.get(lem, 0) + 1
+
+    return [ (word, lemcounts.items())
+             for (word, lemcounts) in counts.iteritems() ]
+
+
+def addToIndex(counts):
+    INDEX.add(counts)
+
+
+def countTablets(handles):
+
+    # The lemma counts of each of a group of tablets, given their
+    # handles; None for a tablet whose counts are already known.
+
+    return [ countLemmata(loadTablet(handle).lines)
+             if handle is not None else None
+             for handle in handles ]
+
+
+def tabletCounts(tablets, cache, pool, args):
+
+    # The lemma counts of each tablet, in order: a partial index per
+    # tablet, for the caller to merge.  Reuse the counts for tablets
+    # we've seen before; the rest are counted a group at a time, across
+    # the pool if there is one.
+
+    def tasks():
+        for group in groupTablets(tablets):
+            keys = [ None ] * len(group)
+            counts = [ None ] * len(group)
+            if cache is not None:
+                keys = [ 'i' + tablet.key for tablet in group ]
+                counts = [ cache.get(key) for key in keys ]
+
+            yield ( (group, keys, counts),
+                    [ tabletHandle(tablet) if tablet_counts is None else None
+                      for (tablet, tablet_counts) in zip(group, counts) ] )
+
+    for ((group, keys, counts), counted) in mapTasks(countTablets, tasks(),
+                                                     pool, args):
+        for (i, tablet) in enumerate(group):
+            if counts[i] is None:
+                counts[i] = counted[i]
+                if cache is not None:
+                    cache[keys[i]] = counts[i]
+
+            yield (tablet, counts[i])
+
+
+def buildIndex(cache, args):
+    global INDEX
+
+    pool = openPool(args)
+
+    if not args.index:
+        for (_, counts) in tabletCounts( ( tablet for (tablet, _)
+                                           in getTablets() ),
+                                         cache, pool, args):
+            addToIndex(counts)
+        closePool(pool)
+        return
+
+    # Keep the index on disk.  If the corpus starts with the tablets the
+    # index was built from, only the tablets after them need be added;
+    # otherwise the index is built again from scratch.  Either way, the
+    # counts come out in the same order as if they had been added one
+    # tablet at a time.
+
+    index = FrequencyIndex(args.index)
+    known = index.tablets()
+
+    matched = 0
+    for (tablet, _) in getTablets():
+        if matched == len(known) or tablet.key != known[matched]:
+            break
+        matched += 1
+
+    if matched < len(known):
+        index.clear()
+        matched = 0
+
+    tablets = ( tablet for (i, (tablet, _)) in enumerate(getTablets())
+                if i >= matched )
+
+    # The counts are added to the index a group of tablets at a time.
+
+    batch = [ ]
+    keys = [ ]
+    for (tablet, counts) in tabletCounts(tablets, cache, pool, args):
+        batch.extend(counts)
+        keys.append(tablet.key)
+        if len(keys) == TABLET_GROUP:
+            index.add(batch)
+            index.add_tablets(keys)
+            (batch, keys) = ( [ ], [ ] )
+
+    index.add(batch)
+    index.add_tablets(keys)
+
+    closePool(pool)
+
+    INDEX = index.load()
+    index.close()
 
 
 def dumpIndex(args):
@@ -122,7 +529,7 @@ def dumpIndex(args):
         with open(args.dumpindex, 'w') as fout:
             fout.write('{\n')
             for word in sorted(INDEX):
-                lemmata = dict( INDEX[word] )
+                lemmata = dict( INDEX.counter(word) )
                 tags = Counter()
 
                 # If it's a lemma, such as "aga'us[soldier]", replace the
@@ -147,25 +554,28 @@ def optimizeIndex(args):
         # Optimize index by throwing away all lemmata except for the
         # most attested one for each word.
 
-        for word in INDEX:
-
-            try:
-                (bestlem, bestcount) = INDEX[word].most_common(1)[0]
-            except IndexError:
-                print 'word:  {}'.format(word)
-                print 'index: {}'.format(INDEX[word])
-                raise
-            INDEX[word] = Counter()
-            INDEX[word][bestlem] = bestcount
+        INDEX.keep_best()
 
 
 def formatLems(lems, args):
+
+    # Each sequence of lemmata is only formatted once per output; the
+    # options that affect formatting are fixed for the run.
+
+    lems = tuple(lems)
+    tag = args.tags.get(lems)
+    if tag is None:
+        tag = args.tags[lems] = formatTag(lems, args)
+    return tag
+
+
+def formatTag(lems, args):
     f = [ ]
 
     for lem in lems:
         if ('[' in lem) and (']' in lem):
             if args.pf:
-                if lem in Context.professions:
+                if Context.is_profession(lem):
                     lem = 'PF'
             if args.nogloss:
                 lem = 'W'
@@ -174,7 +584,27 @@ def formatLems(lems, args):
     return ','.join(f)
 
 
-def getLem(line, word, args): 
+def indexLem(word, args):
+
+    # Tag for a word attested with more than one lemma, which is chosen
+    # from the index rather than from the word's own lemmatization.
+
+    if args.bestlemma:
+
+        # Show only the best lemma for this word.
+
+        lems = [ INDEX.best(word) ]
+
+    else:
+
+        # Show all lemmata.
+
+        lems = INDEX.counter(word)
+
+    return formatLems(lems, args)
+
+
+def getLem(line, index, word, args): 
     if not word in INDEX:
 
         # Word is not lemmatized anywhere in corpus.
@@ -184,41 +614,73 @@ def getLem(line, word, args):
 
     else:
 
-        lems = line.get_lemmata(word)
+        lems = line.get_lemmata_at(index)
 
         if len(lems) > 1:
-            if args.bestlemma:
+            return indexLem(word, args)
+
+    return formatLems(lems, args)
 
-                # Show only the best lemma for this word.
 
-                lems = [ INDEX[word].most_common(1)[0][0] ]
+def printWord(line, index, word, args, features):
 
-            else:
+    # Token 0: word; then the CRF fields, if requested; final token: lem
+    # with which this word was tagged.  The row is built as one string
+    # rather than written a field at a time.
 
-                # Show all lemmata.
+    if features:
+        return word + next(features) + '\t' + \
+               getLem(line, index, word, args) + '\n'
 
-                lems = INDEX[word]
+    return word + '\t' + getLem(line, index, word, args) + '\n'
 
-    return formatLems(lems, args)
 
+def processItems(line, args, rows, features):
+
+    # CRFsuite items: the tag, then the word's attributes.  The words
+    # of a line make up one sequence, ended by a blank line.
+
+    if not line.lem or not line.words:
+        return
+
+    for (index, (word, _)) in enumerate(line.words):
+        rows.append(getLem(line, index, word, args) + next(features) + '\n')
+
+    rows.append('\n')
 
-def printWord(line, index, word, args):
 
-    # Token 0: word
+def renderFeatures(lines, matrix, columns, args):
 
-    stdout.write(word)
+    # Render computed features in the output format.
 
-    # CRF fields, if requested.
+    if args.crfsuite:
+        return Context.attributes([ word for line in lines
+                                    for (word, _) in line.words ],
+                                  matrix, columns, args.features,
+                                  args.hash_bits)
 
-    if args.crf:
-        Context.write(line, index, word, args)
+    return Context.render(matrix, columns, args.features)
 
-    # Final token: lem with which this word was tagged.
 
-    stdout.write( '\t{}\n'.format( getLem(line, word, args) ))
+def damageState(line):
+    damaged = "False"
+    if line.damaged:
+        if line.damaged_and_tagged:
+            damaged = "recoverable"
+        else:
+            damaged = "unrecoverable"
+    return damaged
+
+
+# Opening <l> tag for each damage state.
 
+LINE_OPEN = dict( (damaged, '<l damaged="{}">\n'.format(damaged))
+                  for damaged in ('False', 'recoverable', 'unrecoverable') )
 
-def process(line, args):
+LINE_CLOSE = '</l>\n'
+
+
+def process(line, args, rows, features = None):
 
     """
     print
@@ -243,66 +705,405 @@ def process(line, args):
 
     # Record damage state as an attribute of the <l> tag.
 
-    damaged = "False"
-    if line.damaged:
-        if line.damaged_and_tagged:
-            damaged = "recoverable"
-        else:
-            damaged = "unrecoverable"
-
     if not args.bare:
-        stdout.write('<l damaged="{}">\n'.format(damaged) )
+        rows.append(LINE_OPEN[damageState(line)])
 
     for (index, (word, _)) in enumerate(line.words):
-        printWord(line, index, word, args)
+        rows.append(printWord(line, index, word, args, features))
 
     if not args.bare:
-        stdout.write('</l>\n')
+        rows.append(LINE_CLOSE)
+
+
+def tabletDeps(lines, args):
+
+    # The tags of words with more than one lemma depend on the rest of
+    # the corpus through INDEX.  Record the tags we chose for them, so
+    # that a cached tablet can be checked against the current INDEX.
+
+    return dict( (word, indexLem(word, args))
+                 for line in lines if line.lem
+                 for (word, lemmata) in line.words
+                 if len(lemmata) > 1 )
+
+
+def depsValid(deps, args):
+    for word in deps:
+        if indexLem(word, args) != deps[word]:
+            return False
+    return True
+
+
+def storeRows(tablet, lines, matrix, columns, args):
+
+    # The tablet as FeatureStoreWriter.add_tablet() takes it.  Only
+    # lemmatized lines are written out, as in process().  Lines that
+    # aren't have no words, so they have no feature rows either.
+
+    lines = [ line for line in lines if line.lem ]
+
+    words = [ ]
+    tags = [ ]
+    for line in lines:
+        for (index, (word, _)) in enumerate(line.words):
+            words.append(word)
+            tags.append(getLem(line, index, word, args))
+
+    return (tablet.id,
+            [ (damageState(line), len(line.words)) for line in lines ],
+            words, tags, matrix, columns)
+
+
+def outputFeatures(lines, computed, output):
+
+    # Rendered CRF features of the words of a batch of lines, for one
+    # output.  Features that were already computed are rendered as they
+    # are; otherwise the output's line cache supplies the rows of lines
+    # it has seen.
+
+    if computed is not None:
+        return renderFeatures(lines, computed[0], computed[1], output)
+
+    if output.linecache is None:
+        (matrix, columns) = Context.features(lines, output.features)
+        return renderFeatures(lines, matrix, columns, output)
+
+    def render(lines):
+        (matrix, columns) = Context.features(lines, output.features)
+        return renderFeatures(lines, matrix, columns, output)
+
+    return Context.cached_rows(lines, output.features, output.linecache,
+                               render)
+
+
+def formatTablet(lines, features, output):
+    if output.crfsuite:
+        rows = [ ]
+        for line in lines:
+            processItems(line, output, rows, features)
+    else:
+        rows = [ '\n' ]
+        for line in lines:
+            process(line, output, rows, features)
+
+    return ''.join(rows)
+
+
+def renderTablets(tablets, needed, args):
+
+    # Render a group of tablets.  Returns, for each output, the
+    # (deps, text) of each tablet it needs (None for the others), and
+    # with --store, the store rows of every tablet.
+
+    # Tablet.lines holds the lines that are followed by a lemma; comment
+    # lines among them have no lemma of their own, and process() skips
+    # them.  The store is filled from the tablet's lines and features,
+    # so every tablet is parsed for it.
+
+    lines = [ tablet.lines
+              if args.store or any(output_needed[i]
+                                   for output_needed in needed)
+              else None
+              for (i, tablet) in enumerate(tablets) ]
+
+    # Find where each tablet's words start in the batch of all of the
+    # lines that were parsed.
+
+    batch = [ ]
+    bounds = [ ]
+    start = 0
+    for tablet_lines in lines:
+        if tablet_lines is None:
+            bounds.append(None)
+        else:
+            end = start + sum( [ len(line.words) for line in tablet_lines ] )
+            bounds.append( (start, end) )
+            batch.extend(tablet_lines)
+            start = end
 
+    # Compute the CRF features for all of the tablets at once.  The
+    # store needs the feature values themselves, so with it they are
+    # computed once and rendered for every output.
 
-def parse(args):
-    global LINES
+    computed = None
+    if args.store:
+        computed = Context.features(batch, args.features)
 
-    if args.crf:
-        Context.write_header()
+    rendered = [ ]
+    for (output, output_needed) in zip(args.outputs, needed):
+        features = None
+        if output.crf:
+            features = outputFeatures(batch, computed, output)
 
-    lines = [ ]
+        output_rendered = [ None ] * len(tablets)
+        for (i, tablet) in enumerate(tablets):
+            if not output_needed[i]:
+                continue
+
+            tablet_features = None
+            if features is not None:
+                (start, end) = bounds[i]
+                tablet_features = iter(features[start:end])
+
+            deps = None
+            if args.cache:
+                deps = tabletDeps(lines[i], output)
+
+            output_rendered[i] = \
+                (deps, formatTablet(lines[i], tablet_features, output))
 
-    for line1, line2 in pairwise(LINES):
-        line1 = line1.strip()
-        line2 = line2.strip()
+        rendered.append(output_rendered)
 
-        # Accumulate a line if the line isn't a comment and is
-        # followed by a lemma.
+    rows = None
+    if args.store:
+        (matrix, columns) = computed
+        rows = [ ]
+        for (i, tablet) in enumerate(tablets):
+            (start, end) = bounds[i]
+            rows.append(storeRows(tablet, lines[i], matrix[start:end],
+                                  dict( (key, values[start:end])
+                                        for (key, values)
+                                        in columns.iteritems() ),
+                                  args.store_output))
 
-        if line1[0] not in '&#$@' and line2.startswith('#lem:'):
-            lines.append( Line(line1, line2) )
+    return (rendered, rows)
 
-        # Are we at the end of a tablet ?
 
-        if line2.startswith('&'):
+def lineCacheCounts(args):
+    return [ (output.linecache.hits, output.linecache.misses)
+             if output.linecache else (0, 0)
+             for output in args.outputs ]
 
-            # Starting a new tablet.  Process accumulated lines.
 
-            stdout.write('\n')
-            for line in lines:
-                process(line, args)
+def tagTablets(task):
 
-            # Restart accumulated lines.
+    # Render a group of tablets, given their handles (None for a tablet
+    # that needn't be rendered).  Also returns how the line caches fared,
+    # so that a worker's lookups can be added to the totals kept by the
+    # main process.
+
+    (handles, needed) = task
+    args = JOB_ARGS
+
+    tablets = [ loadTablet(handle) if handle is not None else None
+                for handle in handles ]
+
+    before = lineCacheCounts(args)
+    (rendered, rows) = renderTablets(tablets, needed, args)
+    after = lineCacheCounts(args)
+
+    return (rendered, rows,
+            [ (hits - hits0, misses - misses0)
+              for ((hits0, misses0), (hits, misses)) in zip(before, after) ])
+
+
+def writeTablets(tablets, args, cache, store, pool):
+
+    def tasks():
+        for group in groupTablets(tablets):
+
+            # Reuse the output for a tablet we've seen before, unless
+            # the index has changed the tags of any of its words.
+
+            keys = None
+            texts = [ [ None ] * len(group) for output in args.outputs ]
+            ids = [ tablet.id or '' for tablet in group ]
+            if cache is not None:
+                keys = [ tablet.key for tablet in group ]
+                for (output, output_texts) in zip(args.outputs, texts):
+                    for (i, key) in enumerate(keys):
+                        cached = cache.get(output.prefix + key)
+                        if cached and depsValid(cached[0], output):
+                            output_texts[i] = cached[1]
+
+            needed = [ [ text is None for text in output_texts ]
+                       for output_texts in texts ]
+
+            # Only the tablets to be rendered are handed over.
+
+            yield ( (keys, texts, ids),
+                    ( [ tabletHandle(tablet)
+                        if store or any(output_needed[i]
+                                        for output_needed in needed)
+                        else None
+                        for (i, tablet) in enumerate(group) ],
+                      needed ) )
+
+    for ((keys, texts, ids), (rendered, rows, counts)) \
+            in mapTasks(tagTablets, tasks(), pool, args):
+
+        if args.ids_out:
+            args.ids_out.write(''.join( [ tablet_id + '\n'
+                                          for tablet_id in ids ] ))
+
+        for (output, output_texts, output_rendered) \
+                in zip(args.outputs, texts, rendered):
+            for (i, text) in enumerate(output_texts):
+                if text is None:
+                    (deps, text) = output_rendered[i]
+                    if cache is not None:
+                        cache[output.prefix + keys[i]] = (deps, text)
+
+                output.out.write(text)
+
+        if store:
+            for row in rows:
+                store.add_tablet(*row)
+
+        # The line caches of the workers are their own; keep the totals.
+
+        if pool is not None:
+            for (output, (hits, misses)) in zip(args.outputs, counts):
+                if output.linecache:
+                    output.linecache.hits += hits
+                    output.linecache.misses += misses
+
+
+def parse(args, cache):
+
+    if args.store:
+
+        # Tags in the store are formatted as in the first CRF output.
+
+        args.store_output = [ output for output in args.outputs
+                              if output.crf ][0]
+
+    # Formulaic lines recur throughout the corpus; keep the features of
+    # the most recently seen lines for reuse.  With --jobs, each worker
+    # keeps its own.
+
+    for output in args.outputs:
+        output.linecache = None
+        if output.crf and not args.store and args.line_cache > 0:
+            output.linecache = LineCache(args.line_cache)
+
+    # The workers are started once the index is complete, since tagging
+    # depends on it.
+
+    pool = openPool(args)
+
+    for output in args.outputs:
+
+        # Outputs are written a tablet at a time through a large buffer,
+        # rather than a row at a time.
+
+        if '-' == output.filename:
+            output.out = os.fdopen(os.dup(stdout.fileno()), 'wb',
+                                   OUTPUT_BUFFER)
+        else:
+            output.out = open(output.filename, 'wb', OUTPUT_BUFFER)
+
+        if output.crf and not output.crfsuite:
+            Context.write_header(output.out, output.features)
+
+    store = None
+    if args.store:
+        store = FeatureStoreWriter(args.store, args.features)
+
+    args.ids_out = None
+    if args.ids:
+        args.ids_out = open(args.ids, 'wb', OUTPUT_BUFFER)
+
+    initJob(args)
+    writeTablets( ( tablet for (tablet, written) in getTablets()
+                    if written ),
+                  args, cache, store, pool)
+    closePool(pool)
+
+    for output in args.outputs:
+
+        # Every tablet of the CRF TSV starts with a blank line; end the
+        # last one with a blank line too, so that partition_corpus.py
+        # reads it as a whole tablet.
+
+        if output.crf and not output.crfsuite:
+            output.out.write('\n')
+
+        output.out.close()
+
+    if store:
+        store.close()
+
+    if args.ids_out:
+        args.ids_out.close()
+
+    for output in args.outputs:
+        linecache = output.linecache
+        if linecache:
+            lookups = linecache.hits + linecache.misses
+            stderr.write('Line cache for {}: {} hits, {} misses '
+                         '({:.1f}% hits)\n'
+                             .format('stdout' if '-' == output.filename
+                                                else output.filename,
+                                     linecache.hits, linecache.misses,
+                                     100.0 * linecache.hits
+                                         / max(lookups, 1)))
+
+
+def openCache(args):
+
+    # Each output keeps its tablets' text under its own prefix.
+
+    for (i, output) in enumerate(args.outputs):
+        output.prefix = 'o{}:'.format(i)
+
+    if not args.cache:
+        return None
+
+    # Cached output is only good for the options it was generated with.
+
+    options = (args.nogloss, args.bestlemma,
+               [ feature.key for feature in args.features ],
+               args.hash_bits,
+               [ (output.pf, output.bare, output.crf, output.crfsuite)
+                 for output in args.outputs ])
+
+    cache = shelve.open(args.cache, protocol = 2)
+    if cache.get('options') != options:
+        cache.close()
+        cache = shelve.open(args.cache, flag = 'n', protocol = 2)
+        cache['options'] = options
+
+    return cache
+
+
+def closeCache(cache, args):
+    if cache is None:
+        return
+
+    # Forget tablets that are no longer in the corpus.
+
+    keys = set( [ 'options' ] )
+    for (tablet, _) in getTablets():
+        key = tablet.key
+        keys.add('i' + key)
+        for output in args.outputs:
+            keys.add(output.prefix + key)
+
+    for key in cache.keys():
+        if key not in keys:
+            del cache[key]
+
+    cache.close()
 
-            lines = [ ]
 
 # ====
 # Main
 # ====
 
 args = init_parser()
-readLines()
+openInput(args)
+cache = openCache(args)
 
-buildIndex()
-optimizeIndex(args)
+buildIndex(cache, args)
+
+# The word/tag frequencies are dumped before --bestlemma thins out the
+# index, so that they are the same whatever else this run writes.
 
 if args.dumpindex:
     dumpIndex(args)
 
-parse(args)
+optimizeIndex(args)
+
+parse(args, cache)
+closeCache(cache, args)
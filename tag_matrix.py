@@ -0,0 +1,267 @@
+#!/usr/bin/python
+
+"""
+Word/tag count matrix.
+
+Counts how often each word is tagged with each tag (or lemma), with the
+words and tags numbered and the counts held in NumPy arrays, rather than
+in a Counter per word.  Once every count has been added, the matrix is
+frozen into compressed sparse rows: one row per word, holding the word's
+tags in the order in which they were first added.
+
+The most common tag of every word is found at once, with an argmax over
+each row.  Ties are broken as Counter.most_common() would break them for
+a Counter built up tag by tag in the same order, so the matrix can stand
+in for a dict of such Counters without changing any results.
+"""
+
+from array import array
+from collections import Counter
+
+import numpy
+
+# Number of counts added before they are merged into the rest, which
+# bounds the memory taken by counts that have yet to be summed.
+
+PENDING = 1 << 18
+
+# Type of the row and column numbers, counts and positions.
+
+CODES = numpy.int32
+
+
+class TagMatrix:
+
+    """
+    __init__():
+    ===========
+    Constructor.  Creates an empty matrix.
+    ===========
+    """
+    def __init__(self):
+
+        self.rows = { }             # Word -> row
+        self.words = [ ]            # Row -> word
+        self.columns = { }          # Tag -> column
+        self.tags = [ ]             # Column -> tag
+
+        # Counts added since the last merge: row, column and count of
+        # each, in the order added.
+
+        self.pending = ( array('i'), array('i'), array('i') )
+
+        # Merged counts: row, column, count and the position at which
+        # each word/tag pair was first added, one entry per pair.
+
+        empty = numpy.zeros(0, dtype = CODES)
+        self.merged = ( empty, empty, empty, empty )
+        self.added = 0
+
+        self.frozen = None
+
+
+    def __len__(self):
+        return len(self.words)
+
+
+    def __contains__(self, word):
+        return word in self.rows
+
+
+    def __iter__(self):
+        return iter(self.words)
+
+
+    def add_count(self, word, tag, count):
+
+        row = self.rows.get(word)
+        if row is None:
+            row = self.rows[word] = len(self.words)
+            self.words.append(word)
+
+        column = self.columns.get(tag)
+        if column is None:
+            column = self.columns[tag] = len(self.tags)
+            self.tags.append(tag)
+
+        (rows, columns, counts) = self.pending
+        rows.append(row)
+        columns.append(column)
+        counts.append(count)
+
+        self.frozen = None
+
+        if len(rows) >= PENDING:
+            self.merge()
+
+
+    """
+    add():
+    ===========
+    Add word/tag counts to the matrix.
+    ===========
+    Accepts:
+        counts:     Sequence of (word, [ (tag, count), ... ]), in the
+                        order in which the pairs were seen.
+    ===========
+    """
+    def add(self, counts):
+        for (word, tags) in counts:
+            for (tag, count) in tags:
+                self.add_count(word, tag, count)
+
+
+    def merge(self):
+
+        # Sum the pending counts into the merged ones, keeping the
+        # position at which each pair was first added.
+
+        if not len(self.pending[0]):
+            return
+
+        (rows, columns, counts) = [ numpy.frombuffer(values, dtype = 'i')
+                                        .astype(CODES)
+                                    for values in self.pending ]
+        first = self.added + numpy.arange(len(rows), dtype = CODES)
+        self.added += len(rows)
+
+        rows = numpy.concatenate( (self.merged[0], rows) )
+        columns = numpy.concatenate( (self.merged[1], columns) )
+        counts = numpy.concatenate( (self.merged[2], counts) )
+        first = numpy.concatenate( (self.merged[3], first) )
+
+        order = numpy.lexsort( (first, columns, rows) )
+        (rows, columns, counts, first) = \
+            (rows[order], columns[order], counts[order], first[order])
+
+        starts = numpy.flatnonzero(
+                     numpy.concatenate( ( [ True ],
+                                          (rows[1:] != rows[:-1])
+                                        | (columns[1:] != columns[:-1]) ) ))
+
+        self.merged = ( rows[starts], columns[starts],
+                        numpy.add.reduceat(counts, starts, dtype = CODES),
+                        first[starts] )
+
+        self.pending = ( array('i'), array('i'), array('i') )
+
+
+    def freeze(self):
+
+        # Lay the counts out as compressed sparse rows, each row in
+        # the order in which its tags were first added, and find the
+        # most common tag of every row.
+
+        if self.frozen is not None:
+            return self.frozen
+
+        self.merge()
+
+        (rows, columns, counts, first) = self.merged
+        order = numpy.lexsort( (first, rows) )
+        (rows, columns, counts) = (rows[order], columns[order], counts[order])
+
+        # Keep the counts in this order from now on; positions in it
+        # serve as well as the original ones.
+
+        self.merged = ( rows, columns, counts,
+                        numpy.arange(len(rows), dtype = CODES) )
+
+        best = numpy.zeros(len(self.words), dtype = numpy.int64)
+        offsets = numpy.zeros(len(self.words) + 1, dtype = numpy.int64)
+
+        if len(self.words):
+            lengths = numpy.bincount(rows, minlength = len(self.words))
+            offsets[1:] = numpy.cumsum(lengths)
+            starts = offsets[:-1]
+
+            peaks = numpy.maximum.reduceat(counts, starts)
+            at_peak = counts == numpy.repeat(peaks, lengths)
+
+            # The first entry at the peak of each row, and the rows with
+            # more than one.
+
+            best = numpy.minimum.reduceat(
+                       numpy.where(at_peak, numpy.arange(len(counts)),
+                                   len(counts)),
+                       starts)
+            ties = numpy.flatnonzero(
+                       numpy.add.reduceat(at_peak, starts, dtype = CODES) > 1)
+
+            # Counter.most_common() takes the first of the tied tags in
+            # the Counter's own (hash) order, not the order they were
+            # added in; ask a Counter for the rare rows that have ties.
+
+            for row in ties:
+                tags = [ self.tags[column]
+                         for column in columns[offsets[row]:
+                                               offsets[row + 1]] ]
+                counter = self.counter_of(tags,
+                                          counts[offsets[row]:
+                                                 offsets[row + 1]])
+                tag = counter.most_common(1)[0][0]
+                best[row] = offsets[row] + tags.index(tag)
+
+        self.frozen = (offsets, columns, counts, columns[best])
+        return self.frozen
+
+
+    @staticmethod
+    def counter_of(tags, counts):
+        counter = Counter()
+        for (tag, count) in zip(tags, counts):
+            counter[tag] += int(count)
+        return counter
+
+
+    def items(self, word):
+
+        # (tag, count) of each of a word's tags, in the order in which
+        # they were first added.
+
+        (offsets, columns, counts, _) = self.freeze()
+        row = self.rows[word]
+        (start, end) = (offsets[row], offsets[row + 1])
+
+        return [ (self.tags[column], int(count))
+                 for (column, count) in zip(columns[start:end],
+                                            counts[start:end]) ]
+
+
+    def counter(self, word):
+
+        # The word's counts as a Counter, built up in the same order as
+        # they were added, so that it iterates in the same order as a
+        # Counter kept for the word all along.
+
+        items = self.items(word)
+        return self.counter_of( [ tag for (tag, _) in items ],
+                                [ count for (_, count) in items ] )
+
+
+    def best(self, word):
+
+        # Most common tag of a word, or None for a word with no counts.
+
+        row = self.rows.get(word)
+        if row is None:
+            return None
+        return self.tags[self.freeze()[3][row]]
+
+
+    def keep_best(self):
+
+        # Throw away all counts except those of each word's most common
+        # tag.  A tag occurs only once in a row, so this keeps exactly
+        # one count per word.
+
+        (offsets, columns, counts, best) = self.freeze()
+
+        rows = numpy.repeat(numpy.arange(len(self.words), dtype = CODES),
+                            numpy.diff(offsets))
+        peak = columns == best[rows]
+
+        self.merged = ( rows[peak], columns[peak], counts[peak],
+                        numpy.arange(len(self.words), dtype = CODES) )
+        self.added = len(self.words)
+        self.frozen = None